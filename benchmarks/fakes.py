@@ -0,0 +1,295 @@
+"""
+Offline stand-ins for Telegram and the CRM used by the load test
+"""
+
+import asyncio
+import itertools
+import re
+import sqlite3
+import time
+from types import SimpleNamespace
+from telethon import events
+
+
+class FakeMessage:
+    """A class to represent a Telegram message as the bot sees it."""
+
+    def __init__(self, message_id, chat, text='', reply_to=None, media=None, grouped_id=None):
+        self.id = message_id
+        self.peer_id = SimpleNamespace(user_id=chat)
+        self.chat_id = chat
+        self.message = text
+        self.reply_to = None if reply_to is None else SimpleNamespace(reply_to_msg_id=reply_to)
+        self.media = media
+        self.photo = media
+        self.document = None
+        self.file = None if media is None else SimpleNamespace(size=len(media), name='photo.jpg', ext='.jpg')
+        self.grouped_id = grouped_id
+        self.buttons = None
+
+
+class FakeEvent:
+    """A class to represent a NewMessage event."""
+
+    def __init__(self, message, sender):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.input_chat = message.chat_id
+        self.sender = sender
+
+    async def get_sender(self):
+        return self.sender
+
+
+class FakeCallbackEvent:
+    """A class to represent a CallbackQuery event of an inline button pressed under a bot's message."""
+
+    def __init__(self, telegram, message, data):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.data = data
+        self.answered = False
+        self._telegram = telegram
+
+    async def answer(self, *args, **kwargs):
+        self.answered = True
+
+    async def edit(self, text, buttons=None, **kwargs):
+        self._telegram.calls['edit'] += 1
+        await asyncio.sleep(self._telegram.latency)
+        self.message.message = text
+        self.message.buttons = buttons
+
+        return self.message
+
+
+class FakeTelegram:
+    """
+    A class to represent an in-process TelegramClient.
+
+    Every API call sleeps `latency` seconds to stand for a network round trip.
+    Sent messages are kept per chat, so the workload can reply to them.
+    """
+
+    def __init__(self, latency=0.005):
+        self.latency = latency
+        self.handlers = []
+        self.chats = {}
+        self.calls = {'send_message': 0, 'send_file': 0, 'get_messages': 0, 'download_media': 0, 'edit': 0}
+        self._ids = {}
+        self._bot_counts = {}
+        self._arrivals = {}
+
+    def on(self, builder):
+        def decorator(handler):
+            self.handlers.append((builder, handler))
+            return handler
+
+        return decorator
+
+    async def dispatch(self, event):
+        is_callback = isinstance(event, FakeCallbackEvent)
+        for builder, handler in self.handlers:
+            if isinstance(builder, events.CallbackQuery) != is_callback:
+                continue
+            if builder.func is None or builder.func(event):
+                await handler(event)
+
+    def new_message(self, chat, text='', reply_to=None, media=None, grouped_id=None):
+        """Returns a message the user writes into their chat with the bot."""
+
+        message = FakeMessage(self._next_id(chat), chat, text, reply_to, media, grouped_id)
+        self.chats.setdefault(chat, []).append(message)
+
+        return message
+
+    def bot_count(self, chat):
+        """Returns how many messages the bot has sent to a chat."""
+
+        return self._bot_counts.get(chat, 0)
+
+    async def wait_bot_count(self, chat, count, timeout=30.0):
+        """Waits until the bot has sent `count` messages to a chat."""
+
+        arrival = self._arrivals.setdefault(chat, asyncio.Event())
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.bot_count(chat) < count:
+            arrival.clear()
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                raise TimeoutError(f'No reply from the bot in chat {chat}')
+            try:
+                await asyncio.wait_for(arrival.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_from_bot(self, chat, prefix='', timeout=30.0):
+        """Waits for a bot's message in a chat starting with `prefix` and returns it."""
+
+        count = self.bot_count(chat)
+        message = self.last_from_bot(chat, prefix)
+        while message is None:
+            count += 1
+            await self.wait_bot_count(chat, count, timeout)
+            message = self.last_from_bot(chat, prefix)
+
+        return message
+
+    def last_from_bot(self, chat, prefix=''):
+        """Returns the latest bot's message in a chat starting with `prefix`."""
+
+        for message in reversed(self.chats.get(chat, [])):
+            if getattr(message, 'from_bot', False) and (message.message or '').startswith(prefix):
+                return message
+
+        return None
+
+    async def send_message(self, entity, text, buttons=None, reply_to=None, **kwargs):
+        self.calls['send_message'] += 1
+        await asyncio.sleep(self.latency)
+        return self._store(entity, text, buttons)
+
+    async def send_file(self, entity, file, caption='', **kwargs):
+        self.calls['send_file'] += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(caption, list):
+            caption = caption[0] if caption else ''
+        if isinstance(file, list):
+            # An album is captioned by its first message
+            messages = []
+            for i, item in enumerate(file):
+                message = self._store(entity, caption if i == 0 else '', None)
+                message.media = item
+                messages.append(message)
+            return messages
+
+        message = self._store(entity, caption, None)
+        message.media = file
+
+        return message
+
+    async def edit_message(self, entity, message, text=None, buttons=None, **kwargs):
+        self.calls['edit'] += 1
+        await asyncio.sleep(self.latency)
+        message.message = text
+        message.buttons = buttons
+
+        return message
+
+    async def get_messages(self, entity, ids=None):
+        self.calls['get_messages'] += 1
+        await asyncio.sleep(self.latency)
+        for message in self.chats.get(entity, []):
+            if message.id == ids:
+                return message
+
+        return None
+
+    async def download_media(self, message, file=None):
+        self.calls['download_media'] += 1
+        await asyncio.sleep(self.latency)
+        if hasattr(file, 'write'):
+            file.write(message.media)
+            return file
+
+        return None
+
+    async def get_input_entity(self, user):
+        return user
+
+    def _store(self, entity, text, buttons):
+        message = FakeMessage(self._next_id(entity), entity, text)
+        message.buttons = buttons
+        message.from_bot = True
+        self.chats.setdefault(entity, []).append(message)
+        self._bot_counts[entity] = self._bot_counts.get(entity, 0) + 1
+        arrival = self._arrivals.get(entity)
+        if arrival is not None:
+            arrival.set()
+
+        return message
+
+    def _next_id(self, chat):
+        counter = self._ids.get(chat)
+        if counter is None:
+            counter = itertools.count(1)
+            self._ids[chat] = counter
+
+        return next(counter)
+
+
+class SqliteCrmConnection:
+    """A class to represent a DB-API connection that runs the bot's SQL Server queries on SQLite."""
+
+    def __init__(self, path, latency=0.0):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._latency = latency
+
+    def cursor(self):
+        return SqliteCrmCursor(self._connection.cursor(), self._latency)
+
+    def close(self):
+        self._connection.close()
+
+
+class SqliteCrmCursor:
+    """A class to represent a cursor translating the SQL Server dialect of the bot's queries."""
+
+    _replaces = (
+        (re.compile(r'\[DB\]\.\[dbo\]\.'), ''),
+        (re.compile(r'WITH \(NOLOCK\)'), ''),
+        (re.compile(r'0x([0-9A-Fa-f]+)'), r"X'\1'"),
+    )
+
+    def __init__(self, cursor, latency):
+        self._cursor = cursor
+        self._latency = latency
+
+    def execute(self, query, params=()):
+        for pattern, replace in self._replaces:
+            query = pattern.sub(replace, query)
+        if self._latency:
+            time.sleep(self._latency)
+        self._cursor.execute(query, params)
+
+        return self
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+enterprise_ref = bytes.fromhex('11111111111111111111111111111111')
+manager_ref = bytes.fromhex('22222222222222222222222222222222')
+
+
+def create_crm(path, enterprises, managers):
+    """Fills a SQLite CRM with enterprises assigned to managers round-robin."""
+
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('DROP TABLE IF EXISTS _Reference1111')
+        connection.execute("""
+            CREATE TABLE _Reference1111 (
+                _Code INTEGER PRIMARY KEY,
+                _Description TEXT,
+                _Fld1111 INTEGER,
+                _Fld1111RRef BLOB
+            )
+        """)
+        manager_codes = []
+        for i, manager in enumerate(managers):
+            code = 900000 + i
+            manager_codes.append(code)
+            connection.execute(
+                'INSERT INTO _Reference1111 VALUES (?, ?, ?, ?)',
+                (code, f'Manager {manager}', manager, manager_ref)
+            )
+        for i, code in enumerate(enterprises):
+            connection.execute(
+                'INSERT INTO _Reference1111 VALUES (?, ?, ?, ?)',
+                (code, f'Pharmacy #{code}', manager_codes[i % len(manager_codes)], enterprise_ref)
+            )
+    connection.close()
@@ -0,0 +1,211 @@
+"""
+Replay-based load test of the bot with fake Telegram and CRM
+
+Runs offline: Telegram is replaced with an in-process client and the CRM with SQLite.
+
+    python -m benchmarks.load_test --clients 500 --managers 5
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+from benchmarks.fakes import FakeEvent, FakeTelegram, SqliteCrmConnection, create_crm
+from support_bot import menu, metrics
+from support_bot.bot import Bot
+from support_bot.crm import Crm
+
+
+class Timings:
+    """A class to represent latency samples by name."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def wrap(self, name, handler):
+        async def timed(event):
+            started = time.perf_counter()
+            try:
+                return await handler(event)
+            finally:
+                self.add(name, time.perf_counter() - started)
+
+        return timed
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+
+    return values[index]
+
+
+def write_settings(directory, managers):
+    """Writes the bot's settings for the test and returns their path."""
+
+    path = os.path.join(directory, 'config.ini')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"""[PATHS]
+LOGS = {os.path.join(directory, 'logs.log')}
+AUTH = {os.path.join(directory, 'auth')}
+USERS = {os.path.join(directory, 'users.txt')}
+DOC = {os.path.join(directory, 'doc.pdf')}
+MEDIA = {directory + os.sep}
+
+[MANAGERS]
+DEFAULT = {managers[0]}
+DOCUMENTS = {managers[-1]}
+ADMIN = {managers[0]}
+
+[SEND]
+RATE = 100000
+CHAT_RATE = 100000
+CONCURRENCY = 64
+""")
+
+    return path
+
+
+class Workload:
+    """A class to represent the synthetic clients' and managers' behaviour."""
+
+    topics = [
+        menu.option_goods_find, menu.option_pharmacies_reply, menu.option_pharmacies_stop,
+        menu.option_documents_invoices, menu.option_reports_quality, menu.option_defects_orders,
+    ]
+    sections = [menu.option_goods, menu.option_pharmacies, menu.option_documents, menu.option_reports]
+
+    def __init__(self, bot, telegram, timings, enterprises, browse, comment_ratio, seed):
+        self._bot = bot
+        self._telegram = telegram
+        self._timings = timings
+        self._enterprises = enterprises
+        self._browse = browse
+        self._comment_ratio = comment_ratio
+        self._random = random.Random(seed)
+        self.events = 0
+
+    async def session(self, client):
+        sender = SimpleNamespace(first_name='Client', last_name=str(client), username=None)
+
+        # Auth
+        started = time.perf_counter()
+        await self._client_says(client, sender, '/start')
+        prompt = self._telegram.last_from_bot(client)
+        await self._client_says(client, sender, str(self._random.choice(self._enterprises)), prompt.id)
+        self._timings.add('flow auth', time.perf_counter() - started)
+
+        # Menu browse
+        for _ in range(self._browse):
+            started = time.perf_counter()
+            await self._client_says(client, sender, self._random.choice(self.sections + self.topics))
+            self._timings.add('flow browse', time.perf_counter() - started)
+        await self._client_says(client, sender, menu.option_back)
+
+        if self._random.random() >= self._comment_ratio:
+            return
+
+        # Comment
+        started = time.perf_counter()
+        await self._client_says(client, sender, self._random.choice(self.topics))
+        await self._client_says(client, sender, menu.option_comment)
+        prompt = self._telegram.last_from_bot(client)
+        await self._client_says(client, sender, 'Please help', prompt.id)
+        self._timings.add('flow comment', time.perf_counter() - started)
+
+        # Manager's reply and finish
+        started = time.perf_counter()
+        manager = self._bot._manager_by_ticket(client)
+        forwarded = await self._telegram.wait_from_bot(manager, f'Клієнт: {client}\n')
+        count = self._telegram.bot_count(client)
+        await self._manager_says(manager, 'We are on it', forwarded.id)
+        await self._telegram.wait_bot_count(client, count + 1)
+        await self._manager_says(manager, '/finish_task', forwarded.id)
+        await self._telegram.wait_bot_count(client, count + 2)
+        self._timings.add('flow manager reply', time.perf_counter() - started)
+
+    async def _client_says(self, client, sender, text, reply_to=None):
+        count = self._telegram.bot_count(client)
+        message = self._telegram.new_message(client, text, reply_to)
+        self.events += 1
+        await self._telegram.dispatch(FakeEvent(message, sender))
+        await self._telegram.wait_bot_count(client, count + 1)
+
+    async def _manager_says(self, manager, text, reply_to):
+        message = self._telegram.new_message(manager, text, reply_to)
+        self.events += 1
+        await self._telegram.dispatch(FakeEvent(message, None))
+
+
+async def run(args, directory):
+    managers = [500 + i for i in range(args.managers)]
+    enterprises = [1000 + i for i in range(args.enterprises)]
+    clients = [10_000_000 + i for i in range(args.clients)]
+
+    crm_path = os.path.join(directory, 'crm.db')
+    create_crm(crm_path, enterprises, managers)
+    crm = Crm(lambda: SqliteCrmConnection(crm_path, args.crm_latency), pool_size=4)
+
+    bot = Bot(write_settings(directory, managers), crm=crm)
+    telegram = FakeTelegram(args.telegram_latency)
+    timings = Timings()
+    bot._handle_client = timings.wrap('handler client', bot._handle_client)
+    bot._handle_manager = timings.wrap('handler manager', bot._handle_manager)
+
+    await bot._load_crm_data()
+    bot._attach(telegram)
+
+    workload = Workload(bot, telegram, timings, enterprises, args.browse, args.comment_ratio, args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def session(client):
+        async with semaphore:
+            await workload.session(client)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(client) for client in clients))
+    elapsed = time.perf_counter() - started
+    bot._close()
+
+    print(f'Clients: {len(clients)}, managers: {len(managers)}, enterprises: {len(enterprises)}')
+    print(f'Events: {workload.events} in {elapsed:.2f} s, {workload.events / elapsed:.1f} events/s')
+    print(f'{"":22}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name in sorted(timings.samples):
+        values = timings.samples[name]
+        print(f'{name:22}{len(values):>8}' + ''.join(
+            f'{percentile(values, p) * 1000:>10.2f}' for p in (50, 95, 99)
+        ))
+    print('Telegram calls:', telegram.calls)
+    print('Outbox:', bot._outbox.stats())
+    if args.metrics:
+        print(metrics.registry.render(), end='')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--managers', type=int, default=5)
+    parser.add_argument('--enterprises', type=int, default=100)
+    parser.add_argument('--browse', type=int, default=3, help='menu options a client opens')
+    parser.add_argument('--comment-ratio', type=float, default=0.5, help='share of clients who write a comment')
+    parser.add_argument('--concurrency', type=int, default=50, help='clients active at once')
+    parser.add_argument('--telegram-latency', type=float, default=0.005, help='seconds per Telegram call')
+    parser.add_argument('--crm-latency', type=float, default=0.002, help='seconds per CRM query')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--metrics', action='store_true', help="print the bot's metrics after the run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(args, directory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Collector of the messages of Telegram albums
+"""
+
+import asyncio
+
+
+class AlbumCollector:
+    """
+    A class to represent the albums' collector.
+
+    Every file of an album comes in a separate event sharing the album's `grouped_id`.
+    The first event of an album is added as the album's own and keeps its place in
+    the chat's order, while the other events of the album are absorbed by it. Then
+    collecting the first event waits until no more events of the album come for
+    `window` seconds and gives it the album's messages in its `album` attribute.
+
+    Methods
+    -------
+    add(event) : bool
+        Returns True if the event is to be handled, False if it's absorbed by an album
+    collect(event) : object
+        Waits for the rest of an added event's album and returns the event to be handled
+    """
+
+    max_size = 10
+
+    def __init__(self, window=0.5):
+        self._window = window
+        self._albums = {}
+
+    def add(self, event):
+        grouped_id = getattr(event.message, 'grouped_id', None)
+        if grouped_id is None:
+            return True
+
+        key = (event.chat_id, grouped_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return False
+
+        self._albums[key] = [event]
+
+        return True
+
+    async def collect(self, event):
+        grouped_id = getattr(event.message, 'grouped_id', None)
+        key = (event.chat_id, grouped_id)
+        album = self._albums.get(key)
+        if grouped_id is None or album is None or album[0] is not event:
+            return event
+
+        try:
+            count = 0
+            while count != len(album) and len(album) < self.max_size:
+                count = len(album)
+                await asyncio.sleep(self._window)
+        finally:
+            del self._albums[key]
+
+        messages = sorted((item.message for item in album), key=lambda message: message.id)
+        event.album = messages
+
+        return event
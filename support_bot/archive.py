@@ -0,0 +1,250 @@
+"""
+Archive of the conversations between clients and managers
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+def media_kind(message, album=None):
+    """Returns the kind of a message's (or an album's) media, None if there's none"""
+
+    if album:
+        return 'album'
+    if message.photo is not None:
+        return 'photo'
+    if message.document is not None:
+        return 'document'
+
+    return None
+
+
+class Block:
+    """A class to represent a client's JSON lines to be compressed as one block."""
+
+    __slots__ = ('first_time', 'last_time', 'size', 'lines')
+
+    def __init__(self, first_time):
+        self.first_time = first_time
+        self.last_time = first_time
+        self.size = 0
+        self.lines = []
+
+    def add(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        self.lines.append(line)
+        self.size += len(line)
+        self.last_time = record['time']
+
+    def extend(self, block):
+        self.lines.extend(block.lines)
+        self.size += block.size
+        self.last_time = block.last_time
+
+
+class TranscriptArchive:
+    """
+    A class to represent the transcripts' archive.
+
+    Messages are collected in memory as JSON lines per client, and a background
+    thread writes a client's lines as one zlib-compressed block once they reach
+    `block_size` bytes, are `block_age` seconds old or their time window's segment
+    is over. Blocks are appended to the segment file of the window of their first
+    message, and an index keeps every block's segment, offset and length by client.
+    So a client's history is read by decompressing that client's blocks alone,
+    followed by the lines not written yet.
+
+    Methods
+    -------
+    append(client, manager, author, text, **fields) : None
+        Queues a message to be archived, `author` is either 'client' or 'manager'
+    history(client, since, limit) : list
+        Returns a client's archived messages in time order, blocks on the disk
+    flush(force) : None
+        Writes the blocks that are due, all of them if `force` is True
+    close() : None
+        Flushes the queued messages and stops the writer
+    """
+
+    def __init__(self, path, segment_seconds=24 * 3600, flush_interval=1.0, block_size=64 * 1024,
+                 block_age=3600.0):
+        self._path = path
+        self._segment_seconds = segment_seconds
+        self._flush_interval = flush_interval
+        self._block_size = block_size
+        self._block_age = block_age
+        self._pending = []
+        self._blocks = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._segment = None
+        self._segment_file = None
+
+        os.makedirs(path, exist_ok=True)
+        connection = self._connect()
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS blocks (
+                    client INTEGER NOT NULL,
+                    segment TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    first_time REAL NOT NULL,
+                    last_time REAL NOT NULL
+                )
+            """)
+            connection.execute('CREATE INDEX IF NOT EXISTS blocks_client ON blocks (client, last_time)')
+        self._writer_connection = connection
+
+        self._writer = threading.Thread(target=self._write_loop, name='transcripts', daemon=True)
+        self._writer.start()
+
+    def append(self, client, manager, author, text, **fields):
+        record = {'time': time.time(), 'client': client, 'manager': manager, 'author': author, 'text': text}
+        record.update(fields)
+        with self._lock:
+            self._pending.append(record)
+        self._wakeup.set()
+
+    def history(self, client, since=0.0, limit=None):
+        # A block is either indexed or still collected, never both, while the write lock is held
+        connection = self._connect()
+        try:
+            with self._write_lock:
+                blocks = connection.execute(
+                    'SELECT segment, offset, length FROM blocks WHERE client = ? AND last_time >= ? ORDER BY rowid',
+                    (client, since)
+                ).fetchall()
+                with self._lock:
+                    block = self._blocks.get(client)
+                    unwritten = [] if block is None else list(block.lines)
+                    pending = [record for record in self._pending if record['client'] == client]
+        finally:
+            connection.close()
+
+        records = []
+        files = {}
+        try:
+            for segment, offset, length in blocks:
+                f = files.get(segment)
+                if f is None:
+                    f = open(os.path.join(self._path, segment), 'rb')
+                    files[segment] = f
+                f.seek(offset)
+                lines = zlib.decompress(f.read(length)).decode('utf-8').splitlines()
+                records.extend(record for record in map(json.loads, lines) if record['time'] >= since)
+        finally:
+            for f in files.values():
+                f.close()
+        records.extend(record for record in map(json.loads, unwritten) if record['time'] >= since)
+        records.extend(record for record in pending if record['time'] >= since)
+
+        return records if limit is None else records[-limit:]
+
+    def flush(self, force=False):
+        with self._write_lock:
+            self._flush(force)
+
+    def _flush(self, force):
+        """Writes the due blocks while the write lock is held"""
+
+        now = time.time()
+        with self._lock:
+            for record in self._pending:
+                block = self._blocks.get(record['client'])
+                if block is None:
+                    block = Block(record['time'])
+                    self._blocks[record['client']] = block
+                block.add(record)
+            self._pending = []
+
+            segment = self._segment_name(now)
+            due = {
+                client: block for client, block in self._blocks.items()
+                if force or block.size >= self._block_size or now - block.first_time >= self._block_age
+                or self._segment_name(block.first_time) != segment
+            }
+            for client in due:
+                del self._blocks[client]
+        if not due:
+            return
+
+        by_segment = {}
+        for client, block in due.items():
+            by_segment.setdefault(self._segment_name(block.first_time), []).append((client, block))
+
+        try:
+            rows = []
+            for segment, blocks in sorted(by_segment.items()):
+                f = self._segment_for(segment)
+                for client, block in blocks:
+                    data = zlib.compress(''.join(block.lines).encode('utf-8'))
+                    rows.append((client, segment, f.tell(), len(data), block.first_time, block.last_time))
+                    f.write(data)
+                f.flush()
+            with self._writer_connection:
+                self._writer_connection.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)', rows)
+        except (OSError, sqlite3.Error):
+            # Keep the blocks for the next write, ahead of the lines collected meanwhile
+            with self._lock:
+                for client, block in due.items():
+                    newer = self._blocks.get(client)
+                    if newer is not None:
+                        block.extend(newer)
+                    self._blocks[client] = block
+            raise
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush(force=True)
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._writer_connection.close()
+
+    def _segment_name(self, moment):
+        """Returns the segment file's name of the time window the moment falls into"""
+
+        start = int(moment // self._segment_seconds * self._segment_seconds)
+
+        return time.strftime('%Y%m%d-%H%M%S', time.gmtime(start)) + '.zlog'
+
+    def _segment_for(self, segment):
+        """Returns the open segment file"""
+
+        if segment != self._segment:
+            if self._segment_file is not None:
+                self._segment_file.close()
+            self._segment_file = open(os.path.join(self._path, segment), 'ab')
+            self._segment = segment
+
+        return self._segment_file
+
+    def _write_loop(self):
+        while not self._closed:
+            # The collected lines are written when due, even if no messages come
+            self._wakeup.wait(self._flush_interval if self._blocks else None)
+            self._wakeup.clear()
+            if self._closed:
+                break
+
+            # Let more messages gather to write them in one block per client
+            time.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as e:
+                logging.error('Transcripts write failed: %r', e)
+
+    def _connect(self):
+        connection = sqlite3.connect(os.path.join(self._path, 'index.db'), check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+
+        return connection
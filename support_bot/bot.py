@@ -2,13 +2,41 @@
 Telegram bot implementation using Telethon
 """
 
+import io
 import os
+import time
+import asyncio
 import logging
 import configparser
 import json
-import pyodbc
-from pandas import DataFrame
 from telethon import TelegramClient, events, functions, Button
+from support_bot.cache import TtlCache
+from support_bot.clients import ClientRegistry
+from support_bot.crm import Crm, CrmUnavailable
+from support_bot.directory import Directory
+from support_bot.dispatch import KeyedDispatcher
+from support_bot.listing import ClientListing
+from support_bot.managers import ManagerRegistry
+from support_bot import logs, metrics
+from support_bot.albums import AlbumCollector
+from support_bot.archive import TranscriptArchive, media_kind
+from support_bot.broadcast import Broadcast, Broadcaster
+from support_bot.media import MediaCache, MediaRelay
+from support_bot.outbox import Outbox
+from support_bot.peers import PeerCache
+from support_bot.profiler import SamplingProfiler
+from support_bot.menu import Menu, option_ask, option_comment, text_default, text_auth, prompt_kind, prompt_auth, \
+    prompt_comment, default_hours
+from support_bot.replies import Prompt, ReplyIndex, parse_client
+from support_bot.routing import LoadBalancer
+from support_bot.search import ClientIndex
+from support_bot.sla import SlaScheduler
+from support_bot.store import ClientStore
+
+
+handler_latency = metrics.histogram(
+    'support_bot_handler_seconds', 'Latency of the incoming events handling', ('handler', 'route')
+)
 
 
 class BotSettings:
@@ -42,12 +70,57 @@ class BotSettings:
     def path_users(self):
         return self._read_setting('PATHS', 'USERS')
 
+    def path_store(self):
+        return self._read_setting('PATHS', 'STORE', os.path.splitext(self.path_users())[0] + '.db')
+
+    def path_archive(self):
+        return self._read_setting('PATHS', 'ARCHIVE', os.path.join(os.path.dirname(self.path_users()), 'archive'))
+
+    def archive_segment_hours(self):
+        return float(self._read_setting('ARCHIVE', 'SEGMENT_HOURS', '24'))
+
+    def archive_block_size(self):
+        return int(self._read_setting('ARCHIVE', 'BLOCK_KB', '64')) * 1024
+
+    def archive_block_age(self):
+        return float(self._read_setting('ARCHIVE', 'BLOCK_MINUTES', '60')) * 60
+
     def path_doc(self):
         return self._read_setting('PATHS', 'DOC')
 
     def path_media(self, user):
         return self._read_setting('PATHS', 'MEDIA') + str(user) + '\\'
 
+    def media_album_window(self):
+        return float(self._read_setting('MEDIA', 'ALBUM_WINDOW', '0.5'))
+
+    def media_cache_size(self):
+        return int(self._read_setting('MEDIA', 'CACHE_SIZE', str(64 * 1024 * 1024)))
+
+    def media_cache_age(self):
+        return float(self._read_setting('MEDIA', 'CACHE_AGE', str(24 * 3600)))
+
+    def media_buffer_size(self):
+        return int(self._read_setting('MEDIA', 'BUFFER', str(20 * 1024 * 1024)))
+
+    def send_rate(self):
+        return float(self._read_setting('SEND', 'RATE', '30'))
+
+    def send_chat_rate(self):
+        return float(self._read_setting('SEND', 'CHAT_RATE', '1'))
+
+    def send_concurrency(self):
+        return int(self._read_setting('SEND', 'CONCURRENCY', '8'))
+
+    def broadcast_concurrency(self):
+        return int(self._read_setting('BROADCAST', 'CONCURRENCY', '8'))
+
+    def clients_concurrency(self):
+        return int(self._read_setting('DISPATCH', 'CONCURRENCY', '64'))
+
+    def peers_concurrency(self):
+        return int(self._read_setting('PEERS', 'CONCURRENCY', '16'))
+
     def default_manager(self):
         return int(self._read_setting('MANAGERS', 'DEFAULT'))
 
@@ -57,7 +130,67 @@ class BotSettings:
     def admin_manager(self):
         return int(self._read_setting('MANAGERS', 'ADMIN'))
 
-    def _read_setting(self, section, name):
+    def routing_balance(self):
+        return self._read_setting('ROUTING', 'BALANCE', 'no').lower() in ('1', 'yes', 'true', 'on')
+
+    def managers_refresh_interval(self):
+        return float(self._read_setting('MANAGERS', 'REFRESH', '600'))
+
+    def crm_server(self):
+        return self._read_setting('CRM', 'SERVER', 'server')
+
+    def crm_database(self):
+        return self._read_setting('CRM', 'DATABASE', 'db')
+
+    def crm_user(self):
+        return self._read_setting('CRM', 'USER', 'user')
+
+    def crm_password(self):
+        return self._read_setting('CRM', 'PASSWORD', 'password')
+
+    def crm_pool_size(self):
+        return int(self._read_setting('CRM', 'POOL_SIZE', '4'))
+
+    def crm_timeout(self):
+        return float(self._read_setting('CRM', 'TIMEOUT', '10'))
+
+    def replies_size(self):
+        return int(self._read_setting('CACHE', 'REPLIES', '50000'))
+
+    def cache_size(self):
+        return int(self._read_setting('CACHE', 'SIZE', '10000'))
+
+    def cache_ttl(self):
+        return float(self._read_setting('CACHE', 'TTL', '300'))
+
+    def logs_json(self):
+        return self._read_setting('LOGS', 'FORMAT', 'text').lower() == 'json'
+
+    def logs_level(self):
+        return self._read_setting('LOGS', 'LEVEL', 'WARNING').upper()
+
+    def logs_max_bytes(self):
+        return int(self._read_setting('LOGS', 'MAX_BYTES', str(10 * 1024 * 1024)))
+
+    def logs_backups(self):
+        return int(self._read_setting('LOGS', 'BACKUPS', '5'))
+
+    def logs_queue_size(self):
+        return int(self._read_setting('LOGS', 'QUEUE', '10000'))
+
+    def metrics_port(self):
+        return int(self._read_setting('METRICS', 'PORT', '0'))
+
+    def metrics_dump(self):
+        return self._read_setting('METRICS', 'DUMP', '')
+
+    def metrics_interval(self):
+        return float(self._read_setting('METRICS', 'INTERVAL', '60'))
+
+    def _read_setting(self, section, name, fallback=None):
+        if fallback is not None:
+            return self._parser.get(section, name, fallback=fallback)
+
         return self._parser[section][name]
 
 
@@ -74,20 +207,68 @@ class Bot:
     _telegram = None
     _settings = None
     _clients_data = None
-
-    def __init__(self, path_settings='config.ini'):
+    _clients_version = 0
+    _managers_data = None
+    _sla = None
+    _balancer = None
+    _store = None
+    _crm = None
+    _crm_cache = None
+    _directory = None
+    _menu = None
+    _replies = None
+    _media = None
+    _outbox = None
+    _peers = None
+    _clients_dispatcher = None
+    _profiler = None
+    _archive = None
+    _clients_index = None
+    _searches = None
+    _listing = None
+    _broadcaster = None
+    _broadcasts = None
+    _albums = None
+    _media_cache = None
+    _profiling = None
+
+    def __init__(self, path_settings='config.ini', crm=None):
         self._settings = BotSettings(path_settings)
+        self._crm = self._init_crm() if crm is None else crm
+        self._crm_cache = TtlCache(self._settings.cache_size(), self._settings.cache_ttl())
+        self._managers_data = ManagerRegistry()
+        self._store = ClientStore(self._settings.path_store())
+        self._archive = TranscriptArchive(
+            self._settings.path_archive(), segment_seconds=self._settings.archive_segment_hours() * 3600,
+            block_size=self._settings.archive_block_size(), block_age=self._settings.archive_block_age()
+        )
+        self._sla = SlaScheduler(self._escalate)
+        self._balancer = LoadBalancer()
+        self._directory = Directory()
+        self._menu = Menu()
+        self._replies = ReplyIndex(self._settings.replies_size())
+        self._clients_index = ClientIndex()
+        self._searches = {}
+        self._broadcasts = {}
+        self._albums = AlbumCollector(self._settings.media_album_window())
+        self._media_cache = MediaCache(self._settings.media_cache_size(), self._settings.media_cache_age())
+        self._profiler = SamplingProfiler()
         self._init_clients_data()
+        self._listing = ClientListing(self._clients_data, self._render_clients_page)
+        self._init_tickets()
 
     def start(self):
         """Starting the bot"""
 
         # Logging
-        path_logs = self._settings.path_logs()
-        logging.basicConfig(
-            filename=path_logs,
-            format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
-            level=logging.WARNING
+        settings = self._settings
+        log_pipeline = logs.setup(
+            settings.path_logs(),
+            json_lines=settings.logs_json(),
+            level=settings.logs_level(),
+            max_bytes=settings.logs_max_bytes(),
+            backups=settings.logs_backups(),
+            queue_size=settings.logs_queue_size()
         )
 
         # Initializing
@@ -97,73 +278,179 @@ class Bot:
             self._settings.api_hash()
         )
 
-        managers = self._managers()
+        telegram.loop.run_until_complete(self._load_crm_data())
+        self._attach(telegram)
+
+        self._telegram.start()
+        telegram.loop.run_until_complete(self._warm_up_peers())
+        telegram.loop.run_until_complete(self._resume_broadcasts())
+        tasks = [
+            telegram.loop.create_task(self._watch_managers()),
+            telegram.loop.create_task(self._sla.run()),
+        ]
+        tasks += self._start_metrics(telegram.loop)
+        try:
+            self._telegram.run_until_disconnected()
+        finally:
+            for task in tasks + list(self._broadcasts.values()):
+                task.cancel()
+            self._close()
+            log_pipeline.stop()
+
+    def _start_metrics(self, loop):
+        """Starts serving and dumping the metrics if they're set up, returns the tasks"""
+
+        tasks = []
+        port = self._settings.metrics_port()
+        if port:
+            tasks.append(loop.create_task(metrics.serve(port)))
+        path_dump = self._settings.metrics_dump()
+        if path_dump:
+            tasks.append(loop.create_task(metrics.dump(path_dump, self._settings.metrics_interval())))
+
+        return tasks
+
+    async def _load_crm_data(self):
+        """Loads the managers and the enterprises directory from CRM"""
 
-        @telegram.on(events.NewMessage(chats=managers))
+        managers = await self._managers()
+        self._managers_data.update(managers)
+        await self._load_directory()
+
+    def _attach(self, telegram):
+        """Attaches the bot's handlers and senders to a Telegram client"""
+
+        @telegram.on(events.NewMessage(func=self._is_manager_event))
         async def handler_manager(event):
-            await self._handle_manager(event)
+            if self._albums.add(event):
+                event = await self._albums.collect(event)
+                await self._handle_timed('manager', self._handle_manager, event)
+
+        async def handle_client(event):
+            event = await self._albums.collect(event)
+            await self._handle_timed('client', self._handle_client, event)
+
+        # Each client's messages are handled in order, different clients concurrently
+        self._clients_dispatcher = KeyedDispatcher(handle_client, self._settings.clients_concurrency())
 
-        @telegram.on(events.NewMessage(chats=managers, blacklist_chats=True))
+        @telegram.on(events.NewMessage(func=lambda event: not self._is_manager_event(event)))
         async def handler_client(event):
-            await self._handle_client(event)
+            self._peers.remember(event.chat_id, event.input_chat)
+            # An album takes its place in the client's queue with its first event and is collected there
+            if self._albums.add(event):
+                self._clients_dispatcher.dispatch(event.chat_id, event)
+
+        @telegram.on(events.CallbackQuery(func=self._is_manager_event))
+        async def handler_callback(event):
+            await self._handle_timed('callback', self._handle_callback, event)
 
         self._telegram = telegram
-        self._telegram.start()
-        self._telegram.run_until_disconnected()
+        self._media = MediaRelay(
+            telegram, self._settings.path_media, self._settings.media_buffer_size(), cache=self._media_cache
+        )
+        self._peers = PeerCache(telegram, self._settings.peers_concurrency())
+        self._outbox = Outbox(
+            telegram,
+            rate=self._settings.send_rate(),
+            chat_rate=self._settings.send_chat_rate(),
+            concurrency=self._settings.send_concurrency(),
+            resolve=self._peers.peer
+        )
+        self._broadcaster = Broadcaster(
+            telegram, self._outbox, self._store,
+            resolve=self._peers.peer,
+            concurrency=self._settings.broadcast_concurrency()
+        )
+
+    def _close(self):
+        """Releases the CRM connections and flushes the clients store and the transcripts"""
+
+        self._crm.close()
+        self._store.close()
+        self._archive.close()
+
+    @staticmethod
+    async def _handle_timed(name, handle, event):
+        """Handles an event observing its latency by the handler and the route taken"""
+
+        started = time.perf_counter()
+        route = 'error'
+        try:
+            route = await handle(event) or 'other'
+        finally:
+            seconds = time.perf_counter() - started
+            handler_latency.observe(seconds, name, route)
+            logging.info('Event handled', extra={name: event.chat_id, 'route': route, 'seconds': round(seconds, 6)})
 
     async def _handle_manager(self, event):
-        """Handles events in a manager's chat."""
+        """Handles events in a manager's chat and returns the route name."""
 
         # New message
         message = event.message
         manager = message.peer_id.user_id
         text = message.message
+        album = getattr(event, 'album', None)
+        if album:
+            text = self._album_caption(album)
+        route = 'other'
 
         # Get a client from the reply message
         client = 0
         if message.reply_to is not None:
-            chat = await message.get_chat()
             reply_id = message.reply_to.reply_to_msg_id
-            reply_msg = await self._telegram.get_messages(chat, ids=reply_id)
-            if reply_msg is not None:
-                try:
-                    reply_text = reply_msg.message
-
-                    start_text = 'Клієнт: '
-                    end_text = '\n'
-                    start = reply_text.find(start_text) + len(start_text)
-                    end = reply_text.find(end_text)
-
-                    client = int(reply_text[start:end])
-                except:
-                    client = 0
+            prompt = await self._prompt_by_reply(manager, reply_id)
+            if prompt is not None:
+                client = prompt.client
 
         # Start bot
         if text.startswith('/start'):
+            route = 'start'
             welcome_text = 'Онлайн-помічник вітає Вас!\n'
             welcome_text += 'В цей чат будуть надходити звернення від клієнтів.'
-            await self._telegram.send_message(manager, welcome_text)
+            self._send_message(manager, welcome_text)
 
             doc_text = 'При бажанні можете ознайомитись з інструкцією користувача 👆'
             filepath = self._settings.path_doc()
-            await self._telegram.send_file(manager, filepath, caption=doc_text)
+            self._outbox.send_file(manager, filepath, caption=doc_text)
         # Refresh bot
         elif text.startswith('/refresh'):
+            route = 'refresh'
+            if manager == self._manager_admin():
+                self._crm_cache.clear()
+                report = await self._load_directory()
+                self._send_message(manager, report)
+
+                report = await self._refresh_managers()
+                self._send_message(manager, report)
+
+                report = await self._warm_up_peers()
+                self._send_message(manager, report)
+
+                self._send_message(manager, self._media_cache_report())
+
+                report = await self._refresh_clients_data()
+                self._send_message(manager, report)
+        # Profile bot
+        elif text.startswith('/profile'):
+            route = 'profile'
             if manager == self._manager_admin():
-                old_df = self._clients_data.copy()
-                self._init_clients_data()
-                new_df = self._clients_data
-                for index, row in new_df.iterrows():
-                    find_rows = old_df.loc[old_df['id'] == row['id']]
-                    if find_rows.empty:
-                        continue
-
-                    found_row = find_rows.iloc[0]
-                    row['chatting'] = found_row.chatting
-                    row['text'] = found_row.text
-                    row['documenting'] = found_row.documenting
+                self._start_profile(manager, text)
+        # Search clients
+        elif text.startswith('/search'):
+            route = 'search'
+            query = text.replace('/search', '', 1).strip()
+            if query:
+                self._search_clients(manager, query)
+            else:
+                self._send_message(manager, 'Вкажіть запит: /search назва, код підприємства або ім\'я клієнта')
+        # Broadcast an announcement to clients
+        elif text.startswith('/broadcast'):
+            route = 'broadcast'
+            await self._start_broadcast(manager, message, text.replace('/broadcast', '', 1).strip())
+            return route
         # Initiate a conversation with a client
         elif text.startswith('/initiate_task'):
+            route = 'initiate_task'
             str_id = text.replace('/initiate_task_', '')
             try:
                 client_id = int(str_id)
@@ -171,197 +458,203 @@ class Bot:
                 client_id = 0
 
             if client_id:
-                if self._is_chatting(client_id):
-                    send_text = 'У клієнта вже є відкрите звернення'
-                    await self._telegram.send_message(manager, send_text)
-                    return
-
-                # Send an initiate message to the manager
-                send_text = 'Клієнт: ' + str(client_id)
-                send_text += '\nНапишіть звернення клієнту та відправте його як відповідь на це повідомлення 👇'
-                await self._telegram.send_message(manager, send_text)
-
-                # Send an initiate message to the chosen client
-                new_text = 'Менеджер розпочав діалог, очікуйте на його звернення...'
-                keyboard = Button.force_reply()
-                await self._telegram.send_message(client_id, new_text, buttons=keyboard)
-                self._set_chatting(client_id, True)
+                if not self._initiate_task(manager, client_id):
+                    return route
             else:
                 # Choose a client
-                clients = self._clients_by_manager(manager)
-                send_text = 'Оберіть клієнта, щоб відправити йому звернення:\n'
-                max_len = 2000
-                for el in clients:
-                    cl_id = el['id']
-                    name = el['name']
-                    enterprise = el['enterprise']
-                    send_text += f'{enterprise} ({name}) - /initiate_task_{cl_id}\n'
-                    if len(send_text) > max_len:
-                        await self._telegram.send_message(manager, send_text)
-                        send_text = ''
-                if send_text:
-                    await self._telegram.send_message(manager, send_text)
+                send_text, keyboard = self._listing.page(manager, 0)
+                self._send_message(manager, send_text, buttons=keyboard)
 
         # No conversations without a client's ID
         if not client:
-            return
+            return route
 
+        # Send the client's transcript
+        if text.startswith('/history'):
+            route = 'history'
+            await self._send_history(manager, client)
         # Finish the conversation
-        if text.startswith('/finish_task'):
+        elif text.startswith('/finish_task'):
+            route = 'finish_task'
             if not self._is_chatting(client):
-                return
+                return route
 
             new_text = 'Звернення закрито менеджером'
             keyboard = Button.text('⤴ Головне меню', resize=True)
-            await self._telegram.send_message(client, new_text, buttons=keyboard)
+            self._send_message(client, new_text, buttons=keyboard)
             self._set_chatting(client, False)
         # Continue the conversation
         else:
-            filepath = await self._get_media_from_message(message)
-            if filepath:
-                await self._telegram.send_file(client, filepath, caption=text)
-                os.remove(filepath)
-            else:
-                await self._telegram.send_message(client, text)
-
-    async def _handle_client(self, event):
-        """Handles events in a client's chat."""
-
-        # New message
-        message = event.message
-        client = message.peer_id.user_id
-        manager = self._manager_by_client(client)
-        text = message.message
+            route = 'reply'
+            self._send_relay(client, message, text, album=album)
+            self._archive.append(client, manager, 'manager', text, route=route, media=media_kind(message, album))
+            self._balancer.respond(client)
+            # The first response meets the ticket's response deadline
+            if client in self._sla:
+                self._sla.cancel(client)
+                self._store.save_ticket(client, self._manager_by_ticket(client), None)
 
-        # Global options
-        option_back = '⤴ Головне меню'
-        option_comment = '⁉ Звернутись'
-        option_ask = '⁉ Запитати'
-
-        menu_back = Button.text(option_back, resize=True)
-        menu_comment = [Button.text(option_comment, resize=True), menu_back]
-        menu_ask = [Button.text(option_ask, resize=True), menu_back]
-        menu_reply = Button.force_reply()
-
-        # Main menu
-        option_goods = '💊 Товари'
-        option_pharmacies = '🏥 Аптеки'
-        option_documents = '📑 Документи'
-        option_reports = '📈 Звіти'
-        option_defects = '🛠 Технічний збій'
-
-        menu_main = [
-            [Button.text(option_goods, resize=True), Button.text(option_pharmacies, resize=True)],
-            [Button.text(option_documents, resize=True), Button.text(option_reports, resize=True)],
-            [Button.text(option_defects, resize=True)]
-        ]
+        return route
 
-        # Goods menu
-        option_goods_find = '🔎 Товар не відображається'
-        option_goods_add = '📥 Додати новий товар'
-        option_goods_link = '🪢 Змінити прив\'язку товара'
+    async def _handle_callback(self, event):
+        """Handles inline buttons pressed in a manager's chat and returns the route name."""
 
-        menu_goods = [
-            [Button.text(option_goods_find, resize=True)],
-            [Button.text(option_goods_add, resize=True)],
-            [Button.text(option_goods_link, resize=True)],
-            menu_ask
-        ]
+        manager = event.chat_id
+        route = 'other'
 
-        # Pharmacies menu
-        option_pharmacies_find = '🔎 Аптека не відображається'
-        option_pharmacies_reply = '🔄 Відповідь на звернення'
-        option_pharmacies_add = '🏥 Додати нову аптеку'
-        option_pharmacies_schedule = '📆 Змінити графік'
-        option_pharmacies_phone = '☎ Змінити номер'
-        option_pharmacies_map = '🗺 Змінити точку'
-        option_pharmacies_name = '🆕 Змінити назву'
-        option_pharmacies_disable = '🚫 Відключити аптеку'
-        option_pharmacies_stop = '❌ Відключити мережу'
-        option_pharmacies_client = '📞 Номер клієнта'
-
-        menu_pharmacies = [
-            [Button.text(option_pharmacies_find, resize=True), Button.text(option_pharmacies_reply, resize=True)],
-            [Button.text(option_pharmacies_add, resize=True), Button.text(option_pharmacies_client, resize=True)],
-            [Button.text(option_pharmacies_schedule, resize=True), Button.text(option_pharmacies_phone, resize=True)],
-            [Button.text(option_pharmacies_map, resize=True), Button.text(option_pharmacies_name, resize=True)],
-            [Button.text(option_pharmacies_disable, resize=True)],
-            [Button.text(option_pharmacies_stop, resize=True)],
-            menu_ask
-        ]
+        # The button is answered whatever its data is, so the manager's client stops waiting
+        try:
+            kind, _, value = event.data.decode('utf-8').partition(':')
+            number = int(value)
+        except ValueError:
+            route = 'invalid_button'
+            kind = None
+            number = 0
+        try:
+            # Turn a page of the client list
+            if kind == 'list':
+                route = 'list_page'
+                text, buttons = self._listing.page(manager, number)
+                self._outbox.submit(manager, lambda: event.edit(text, buttons=buttons))
+            # Turn a page of search results
+            elif kind == 'search':
+                route = 'search_page'
+                text, buttons = self._search_page(manager, number)
+                self._outbox.submit(manager, lambda: event.edit(text, buttons=buttons))
+            # Initiate a conversation with a found client
+            elif kind == 'initiate':
+                route = 'initiate_task'
+                self._initiate_task(manager, number)
+        finally:
+            await event.answer()
+
+        return route
+
+    def _initiate_task(self, manager, client):
+        """Starts a conversation of the manager with the client, returns False if it can't be started"""
+
+        if not self._is_auth(client):
+            send_text = 'Клієнта ' + str(client) + ' не зареєстровано'
+            self._send_message(manager, send_text)
+            return False
+
+        if self._is_chatting(client):
+            send_text = 'У клієнта вже є відкрите звернення'
+            self._send_message(manager, send_text)
+            return False
+
+        # Send an initiate message to the manager
+        send_text = 'Клієнт: ' + str(client)
+        send_text += '\nНапишіть звернення клієнту та відправте його як відповідь на це повідомлення 👇'
+        self._send_message(manager, send_text, client)
+
+        # Send an initiate message to the chosen client
+        new_text = 'Менеджер розпочав діалог, очікуйте на його звернення...'
+        keyboard = Button.force_reply()
+        self._send_message(client, new_text, buttons=keyboard)
+        self._set_chatting(client, True, manager=manager)
+
+        return True
+
+    def _search_clients(self, manager, query):
+        """Searches the manager's clients (all of them for the admin) and sends the first page of results"""
+
+        within = None if manager == self._manager_admin() else self._clients_data.ids_by_manager(manager)
+        self._searches[manager] = (query, self._clients_index.search(query, within))
+        text, buttons = self._search_page(manager, 0)
+        self._send_message(manager, text, buttons=buttons)
+
+    def _search_page(self, manager, page, size=10):
+        """Returns the text and the inline buttons of a page of the manager's latest search"""
+
+        query, found = self._searches.get(manager, ('', []))
+        if not found:
+            return f'За запитом «{query}» нічого не знайдено', None
+
+        pages = (len(found) + size - 1) // size
+        page = max(0, min(page, pages - 1))
+        buttons = []
+        for client in found[page * size:(page + 1) * size]:
+            record = self._clients_data.record(client)
+            if record is not None:
+                label = f'{record.enterprise} ({record.name})'
+                buttons.append([Button.inline(label, data=f'initiate:{client}'.encode())])
+        navigation = self._page_buttons('search', page, pages)
+        if navigation:
+            buttons.append(navigation)
+
+        text = f'Пошук «{query}»: знайдено {len(found)}, сторінка {page + 1} з {pages}\n'
+        text += 'Оберіть клієнта, щоб відправити йому звернення:'
+
+        return text, buttons
+
+    def _render_clients_page(self, records, page, pages):
+        """Returns the text and the inline buttons of a page of a manager's client list"""
+
+        if not records:
+            return 'За Вами не закріплено жодного клієнта', None
+
+        buttons = []
+        for record in records:
+            label = f'{record.enterprise} ({record.name})'
+            buttons.append([Button.inline(label, data=f'initiate:{record.id}'.encode())])
+        navigation = self._page_buttons('list', page, pages)
+        if navigation:
+            buttons.append(navigation)
+
+        text = f'Оберіть клієнта, щоб відправити йому звернення (сторінка {page + 1} з {pages}):'
+
+        return text, buttons
 
-        # Documents menu
-        option_documents_contracts = '📜 Договори'
-        option_documents_invoices = '🧾 Рахунки'
-        option_documents_acts = '📇 Акти'
-        option_documents_contact = '👤 Змінити контактну особу'
-
-        menu_documents = [
-            [Button.text(option_documents_contracts, resize=True)],
-            [Button.text(option_documents_invoices, resize=True), Button.text(option_documents_acts, resize=True)],
-            [Button.text(option_documents_contact, resize=True)],
-            menu_ask
-        ]
+    @staticmethod
+    def _page_buttons(kind, page, pages):
+        """Returns the inline buttons turning the pages of a listing"""
 
-        # Reports menu
-        option_reports_link = '🪢 Товари без прив\'язки'
-        option_reports_quality = '📈 Якість'
-        option_reports_competitors = '🗺 Оточення'
-        option_reports_finance = '💰 Фінанси'
-
-        menu_reports = [
-            [Button.text(option_reports_link, resize=True)],
-            [
-                Button.text(option_reports_quality, resize=True),
-                Button.text(option_reports_competitors, resize=True),
-                Button.text(option_reports_finance, resize=True)
-            ],
-            menu_ask
-        ]
+        buttons = []
+        if page > 0:
+            buttons.append(Button.inline('⬅', data=f'{kind}:{page - 1}'.encode()))
+        if page < pages - 1:
+            buttons.append(Button.inline('➡', data=f'{kind}:{page + 1}'.encode()))
 
-        # Defects menu
-        option_defects_account = '🖥 Особистий кабінет'
-        option_defects_orders = '🛒 Замовлення'
-        option_defects_rests = '📦 Залишки'
+        return buttons
 
-        menu_defects = [
-            [Button.text(option_defects_account, resize=True)],
-            [Button.text(option_defects_orders, resize=True), Button.text(option_defects_rests, resize=True)],
-            menu_ask
-        ]
+    async def _handle_client(self, event):
+        """Handles events in a client's chat and returns the route name."""
 
-        # Common text
-        text_auth = 'Для початку роботи необхідно авторизуватись.\n' \
-                    'Введіть код підприємства 👇'
-        text_comment = 'Будь ласка, напишіть Ваше звернення 🖌'
-        text_ask = 'Попередження!\n' \
-                   'Якщо звернутись до менеджера без вибору типу запитання, ' \
-                   'Ваше звернення може оброблятися більш тривалий термін (до 48 годин).\n' + text_comment
+        # New message
+        message = event.message
+        client = message.peer_id.user_id
+        manager = self._manager_by_client(client)
+        text = message.message
+        album = getattr(event, 'album', None)
+        if album:
+            text = self._album_caption(album)
+        menu = self._menu
 
         # Default data
-        new_text = 'Оберіть, будь ласка, розділ, користуючись кнопками нижче 👇'
-        keyboard = menu_comment
+        new_text = text_default
+        keyboard = menu.menu_comment
 
-        # Previous text
-        prev_text = ''
+        # Previous prompt
+        prev_prompt = ''
         if message.reply_to is not None:
             reply_id = message.reply_to.reply_to_msg_id
-            reply_msg = await self._telegram.get_messages(client, ids=reply_id)
-            if reply_msg is not None:
-                prev_text = reply_msg.message
+            prompt = await self._prompt_by_reply(client, reply_id)
+            if prompt is not None:
+                prev_prompt = prompt.kind
 
         # Respond type
-        is_auth = True if prev_text.endswith(text_auth) else False
-        is_main = True if text.startswith('/start') or text == option_back else False
+        is_auth = True if prev_prompt == prompt_auth else False
 
         # Auth
         if is_auth:
+            route = 'auth'
             try:
                 code = int(text)
             except:
                 code = 0
 
-            if code and code in self._get_enterprises_from_crm():
+            if code and code in await self._get_enterprises_from_crm():
                 name = ''
                 sender = await event.get_sender()
                 if sender is not None:
@@ -378,289 +671,78 @@ class Bot:
                         if name:
                             name += ' '
                         name += '(' + user_name + ')'
-                manager = self._manager_by_enterprise(code)
+                manager = await self._manager_by_enterprise(code)
                 self._set_auth(client, name, code, manager)
 
-                ent_names = self._get_enterprise_name_from_crm(code)
+                ent_names = await self._get_enterprise_name_from_crm(code)
                 new_text = 'Ви зареєструвалися як представник підприємства ' + ent_names[0] + '.\n' + new_text
-                keyboard = menu_main
+                keyboard = menu.menu_main
             else:
                 new_text = 'Невірний код підприємства!\n'
                 new_text += '(для уточнення коду зателефонуйте менеджеру)\n\n'
                 new_text += text_auth
-                keyboard = menu_reply
+                keyboard = menu.menu_reply
         # Need auth
         elif not self._is_auth(client):
+            route = 'need_auth'
             new_text = text_auth
-            keyboard = menu_reply
+            keyboard = menu.menu_reply
         # Task: Conversation
         elif self._is_chatting(client):
+            route = 'chatting'
             name = self._client_name(client)
-            if self._is_documenting(client):
-                manager = self._manager_by_documents()
-            filepath = await self._get_media_from_message(message)
+            manager = self._manager_by_ticket(client)
 
             send_text = 'Клієнт: ' + str(client)
             send_text += '\nІм\'я: ' + name
             send_text += '\n' + text
-            if filepath:
-                await self._telegram.send_file(manager, filepath, caption=send_text)
-                os.remove(filepath)
-            else:
-                await self._telegram.send_message(manager, send_text)
+            self._send_relay(manager, message, send_text, client, album)
+            self._archive.append(client, manager, 'client', text, route=route, media=media_kind(message, album))
 
             new_text = ''
-            keyboard = menu_reply
+            keyboard = menu.menu_reply
         # Ask/Comment
-        elif prev_text in (text_ask, text_comment):
+        elif prev_prompt == prompt_comment:
+            route = 'comment'
             name = self._client_name(client)
             enterprise = self._enterprise_by_client(client)
             topic = self._get_last_text(client)
-            filepath = await self._get_media_from_message(message)
             if self._is_documenting(client):
                 manager = self._manager_by_documents()
+            elif self._settings.routing_balance():
+                manager = await self._manager_by_load(client, enterprise)
 
             send_text = 'Клієнт: ' + str(client)
             send_text += '\nІм\'я: ' + name
             send_text += '\nПідприємство: ' + str(enterprise)
             send_text += '\nТема: ' + topic
             send_text += '\nТекст: ' + text
-            if filepath:
-                await self._telegram.send_file(manager, filepath, caption=send_text)
-                os.remove(filepath)
-            else:
-                await self._telegram.send_message(manager, send_text)
-            self._set_chatting(client, True)
-
-            max_hours = 48
-            # Goods
-            if topic == option_goods_find:
-                max_hours = 6
-            elif topic == option_goods_add:
-                max_hours = 24
-            elif topic == option_goods_link:
-                max_hours = 24
-            # Pharmacies
-            elif topic == option_pharmacies_find:
-                max_hours = 6
-            elif topic == option_pharmacies_reply:
-                max_hours = 4
-            elif topic == option_pharmacies_add:
-                max_hours = 24
-            elif topic == option_pharmacies_schedule:
-                max_hours = 6
-            elif topic == option_pharmacies_phone:
-                max_hours = 24
-            elif topic == option_pharmacies_map:
-                max_hours = 24
-            elif topic == option_pharmacies_name:
-                max_hours = 6
-            elif topic == option_pharmacies_disable:
-                max_hours = 4
-            elif topic == option_pharmacies_stop:
-                max_hours = 2
-            elif topic == option_pharmacies_client:
-                max_hours = 6
-            # Documents
-            elif topic == option_documents_contracts:
-                max_hours = 24
-            elif topic == option_documents_invoices:
-                max_hours = 6
-            elif topic == option_documents_acts:
-                max_hours = 24
-            elif topic == option_documents_contact:
-                max_hours = 24
-            # Reports
-            elif topic == option_reports_link:
-                max_hours = 24
-            elif topic == option_reports_quality:
-                max_hours = 24
-            elif topic == option_reports_competitors:
-                max_hours = 24
-            elif topic == option_reports_finance:
-                max_hours = 24
-            # Defects
-            elif topic == option_defects_account:
-                max_hours = 24
-            elif topic == option_defects_orders:
-                max_hours = 6
-            elif topic == option_defects_rests:
-                max_hours = 6
-
+            self._send_relay(manager, message, send_text, client, album)
+            self._archive.append(
+                client, manager, 'client', text, route=route, topic=topic, enterprise=enterprise,
+                media=media_kind(message, album)
+            )
+
+            max_hours = menu.hours(topic)
+            self._set_chatting(client, True, max_hours, manager)
             new_text = f'Звернення відправлено - очікуйте відповідь менеджера (до {max_hours} годин)'
-            keyboard = menu_reply
-        # Option Ask/Comment
-        elif text in (option_ask, option_comment):
-            if text == option_ask:
-                new_text = text_ask
-            else:
-                new_text = text_comment
-            keyboard = menu_reply
-        # Section Main
-        elif is_main:
-            keyboard = menu_main
-            self._set_documenting(client, False)
-        # Section Goods
-        elif text == option_goods:
-            keyboard = menu_goods
-        # Goods Option: Find
-        elif text == option_goods_find:
-            new_text = 'Товар може не відображатися з деяких причин, основні з яких:\n' \
-                       ' 🔹 Аптека не надсилає залишки товару\n' \
-                       ' 🔹 Ціна резервування товару вища від ціни в аптеці\n' \
-                       ' 🔹 Відсутня прив\'язка товарної позиції\n' \
-                       ' 🔹 Товар заблокований\n' \
-                       ' 🔹 Аптека відключена\n' \
-                       'Ви можете знайти причину, користуючись інструкцією за посиланням:\n' \
-                       'У разі, якщо причина не виявлена, надішліть звернення менеджеру, ' \
-                       'натиснувши кнопку «' + option_comment + '» та вкажіть:\n' \
-                       ' 🔹 Назву товару\n' \
-                       ' 🔹 Виробника\n' \
-                       ' 🔹 Внутрішній код товару\n' \
-                       ' 🔹 Серійний номер аптеки'
-        # Goods Option: Add
-        elif text == option_goods_add:
-            new_text = 'Додавання нового товару в каталог можливо ' \
-                       'у разі одержання від заявника інформації про товар в наступному форматі:\n' \
-                       'Товарна позиція буде введена в каталог, а по факту ' \
-                       'введення картки товару в каталог, Вас повідомлять 🔔'
-        # Goods Option: Link
-        elif text == option_goods_link:
-            new_text = 'У разі виявлення некоректної прив\'язки товару, є можливість її відкоригувати, ' \
-                       'виконавши дії, описані в інструкції за посиланням:\n' \
-                       'Після проведення прив\'язки товару в особистому кабінеті, ' \
-                       'вона проходить модерацію і тільки після цього фіксуються зміни 🪢'
-        # Section Pharmacies
-        elif text == option_pharmacies:
-            keyboard = menu_pharmacies
-        # Pharmacies Option: Find
-        elif text == option_pharmacies_find:
-            new_text = 'Припинення відображення аптеки на можливо за таких обставин:\n' \
-                       ' 🔹 Аптека відключена в особистому кабінеті\n' \
-                       ' 🔹 Своєчасно несплачені рахунки\n' \
-                       ' 🔹 Є неотримані/необроблені замовлення\n' \
-                       ' 🔹 Відсутнє оновлення інформації по залишкам товарів і цін більше доби\n' \
-                       'Самостійно виявити причину можливо, користуючись інструкцією за посиланням:\n' \
-                       'Якщо не знайшли відповіді, звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '» та вкажіть СЕРІЙНИЙ НОМЕР аптеки 👇'
-            # Pharmacies Option: Reply
-        elif text == option_pharmacies_reply:
-            new_text = 'Натисніть кнопку «' + option_comment + '» та впишіть відповідь на звернення 👇'
-        # Pharmacies Option: Add
-        elif text == option_pharmacies_add:
-            new_text = 'Для того, щоб додати нову аптеку 🏥 з метою її подальшої трансляції, ' \
-                       'потрібно виконати дії описані в інструкції за посиланням:\n' \
-                       'По факту додавання аптеки в реєстр менеджер по роботі з аптечними мережами ' \
-                       'відправить Вам серійний номер цієї аптеки для подальшого вивантаження даних залишків і цін.'
-        # Pharmacies Option: Schedule/Phone
-        elif text == option_pharmacies_schedule or text == option_pharmacies_phone:
-            new_text = 'Змінити 📆 графік роботи аптеки або ☎ телефон можливо, ' \
-                       'користуючись інструкцією за посиланням:\n'
-        # Pharmacies Option: Map
-        elif text == option_pharmacies_map:
-            new_text = 'В разі виявлення помилки щодо розташування аптеки на карті 🗺 ' \
-                       'можливо змінити точку, користуючись інструкцією за посиланням:\n' \
-                       'Після встановлення нової геолокації в особистому кабінеті, ' \
-                       'зміни проходять перевірку та, після підтвердження менеджером, фіксуються на карті 📍'
-        # Pharmacies Option: Name
-        elif text == option_pharmacies_name:
-            new_text = 'Для зміни назви аптеки виконайте дії, вказані в інструкції за посиланням:\n'
-        # Pharmacies Option: Disable
-        elif text == option_pharmacies_disable:
-            new_text = 'Відключити аптеку 🚫 від трансляції на сайті можливо самостійно в особистому кабінеті, ' \
-                       'користуючись інструкцією за посиланням:\n' \
-                       'Якщо аптека відключається на тривалий термін 📆 і в наступному місяці ' \
-                       'не планується робота, обов\'язково ПОВІДОМТЕ про це менеджера❗ 👇'
-        # Pharmacies Option: Stop
-        elif text == option_pharmacies_stop:
-            new_text = 'Для відключення мережі ❌ від трансляції, потрібно передати інформацію менеджеру.\n' \
-                       'Для цього натисніть кнопку «' + option_comment + '» ' \
-                       'та обов\'язково повідомте причину відключення 👇'
-        # Pharmacies Option: Client
-        elif text == option_pharmacies_client:
-            new_text = 'Вкажіть номер броні та причину необхідності надання номера телефона клієнта 👇'
-        # Section Documents
-        elif text == option_documents:
-            keyboard = menu_documents
-        # Documents Option: Contracts
-        elif text == option_documents_contracts:
-            new_text = 'Питання по договорам Ви можете направити менеджеру.\n' \
-                       'Для цього натисніть кнопку «' + option_comment + '» та надішліть запитання 👇'
-            self._set_documenting(client, True)
-        # Documents Option: Invoices
-        elif text == option_documents_invoices:
-            new_text = 'Питання по рахункам Ви можете направити менеджеру.\n' \
-                       'Для цього натисніть кнопку «' + option_comment + '» та надішліть запитання 👇'
-            self._set_documenting(client, True)
-        # Documents Option: Acts
-        elif text == option_documents_acts:
-            new_text = 'Питання по актам Ви можете направити менеджеру.\n' \
-                       'Для цього натисніть кнопку «' + option_comment + '» та надішліть запитання 👇'
-            self._set_documenting(client, True)
-        # Documents Option: Contact
-        elif text == option_documents_contact:
-            new_text = 'При зміні відповідальної особи, ' \
-                       'прохання надати інформацію про ПІБ, контактний телефон, e-mail нової контактної особи.\n' \
-                       'Натисніть кнопку «' + option_comment + '» та введіть інформацію для відправки даних 👇'
-        # Section Reports
-        elif text == option_reports:
-            keyboard = menu_reports
-        # Reports Option: Link
-        elif text == option_reports_link:
-            new_text = 'Детальна інструкція по роботі зі звітом «Товари без прив\'язки» ' \
-                       'та опис полів звіту є за посиланням:\n' \
-                       'Якщо Ви не знайшли відповідь на своє запитання, звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Reports Option: Quality
-        elif text == option_reports_quality:
-            new_text = 'Детальна інструкція по роботі зі звітом «Якість» ' \
-                       'та опис полів звіту є за посиланням:\n' \
-                       'Якщо Ви не знайшли відповідь на своє запитання, звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Reports Option: Competitors
-        elif text == option_reports_competitors:
-            new_text = 'Детальна інструкція по роботі зі звітом «Оточення» ' \
-                       'та опис полів звіту є за посиланням:\n' \
-                       'Якщо Ви не знайшли відповідь на своє запитання, звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Reports Option: Finance
-        elif text == option_reports_finance:
-            new_text = 'Детальна інструкція по роботі зі звітом «Фінансовий» ' \
-                       'та опис полів звіту є за посиланням:\n' \
-                       'Якщо Ви не знайшли відповідь на своє запитання, звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Section Defects
-        elif text == option_defects:
-            keyboard = menu_defects
-        # Defects Option: Account
-        elif text == option_defects_account:
-            new_text = 'Якщо Ви не можете відкрити сторінку 🖥 особистого кабінету, ' \
-                       'або зафіксовано ⚠ збій в роботі, будь ласка, оформіть заявку в службу підтримки:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Defects Option: Orders
-        elif text == option_defects_orders:
-            new_text = 'Якщо в аптеку не надходять вже сформовані клієнтами 🛒 замовлення, ' \
-                       'потрібно звернутись до IT-спеціалістів свого підприємства!\n' \
-                       'В разі, якщо технічні спеціалісти аптеки не можуть 😞 вирішити питання, ' \
-                       'звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Defects Option: Rests
-        elif text == option_defects_rests:
-            new_text = 'Перевірити статус надходження 📦 залишків можливо, ' \
-                       'виконавши дії згідно інструкціЇ за посиланням:\n' \
-                       'Якщо Ви не знайшли відповідь на своє запитання, звертайтесь до менеджера:\n' \
-                       'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
-                       'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
-        # Invalid input response
+            keyboard = menu.menu_reply
+        # Menu options
         else:
-            new_text = 'Невірна команда ⚠\n' + new_text
-            keyboard = menu_main
+            option = menu.route(text)
+            # Invalid input response
+            if option is None:
+                route = 'invalid'
+                new_text = 'Невірна команда ⚠\n' + new_text
+                keyboard = menu.menu_main
+            else:
+                route = 'menu'
+                if option.text is not None:
+                    new_text = option.text
+                if option.keyboard is not None:
+                    keyboard = option.keyboard
+                if option.documenting is not None:
+                    self._set_documenting(client, option.documenting)
 
         # Setting the client's recent input to memorize a topic
         if text not in (option_ask, option_comment):
@@ -668,37 +750,340 @@ class Bot:
 
         # Draw menu
         if new_text:
-            await event.reply(new_text, buttons=keyboard)
+            self._send_message(client, new_text, client, buttons=keyboard, reply_to=message.id)
+
+        return route
+
+    def _send_message(self, chat, text, client=None, **kwargs):
+        """Queues a message to a chat, indexing it as a prompt about the given client"""
+
+        future = self._outbox.send_message(chat, text, **kwargs)
+        if client is not None:
+            self._remember_on_sent(chat, future, client)
+
+        return future
+
+    def _send_relay(self, chat, message, text, client=None, album=None):
+        """Queues a relay of a message (or an album) with its media to a chat"""
+
+        async def relay():
+            peer = self._peers.peer(chat)
+            if album:
+                sent = await self._media.relay_album(peer, album, text) or None
+            else:
+                sent = await self._media.relay(peer, message, text, chat)
+            if sent is None:
+                sent = await self._telegram.send_message(peer, text)
+            return sent
+
+        future = self._outbox.submit(chat, relay)
+        if client is not None:
+            self._remember_on_sent(chat, future, client)
+
+        return future
+
+    def _media_cache_report(self):
+        """Returns a report on the media cache"""
+
+        stats = self._media_cache.stats()
+        report = f'Кеш медіа: {stats["handles"]} файлів у чатах (влучань {stats["handles_hit_ratio"]:.0%}), '
+        report += f'{stats["contents"]} завантажених файлів, {stats["contents_bytes"] / 1024 / 1024:.1f} МБ '
+        report += f'(влучань {stats["contents_hit_ratio"]:.0%})'
+
+        return report
+
+    @staticmethod
+    def _album_caption(album):
+        """Returns the caption of an album, it may come with any of its messages"""
+
+        return next((message.message for message in album if message.message), '')
+
+    def _remember_on_sent(self, chat, future, client):
+        """Indexes a queued message as a prompt once it's sent"""
+
+        def remember(done):
+            if not done.cancelled() and done.exception() is None:
+                sent = done.result()
+                # Any message of an album may be replied
+                for message in sent if isinstance(sent, list) else [sent]:
+                    self._remember_prompt(chat, message, client)
+
+        future.add_done_callback(remember)
 
-    async def _get_media_from_message(self, msg):
-        user = msg.peer_id.user_id
-        media = msg.media
-        filepath = ''
-        if media is not None:
-            filepath = self._settings.path_media(user)
-            filepath = await self._telegram.download_media(msg, filepath)
+    async def _prompt_by_reply(self, chat, reply_id):
+        """Returns the prompt of the bot's message replied in a chat"""
 
-        return filepath
+        prompt = self._replies.get(chat, reply_id)
+        if prompt is None:
+            reply_msg = await self._telegram.get_messages(chat, ids=reply_id)
+            if reply_msg is None:
+                return None
+
+            reply_text = reply_msg.message
+            prompt = Prompt(prompt_kind(reply_text), parse_client(reply_text))
+            self._replies.add(chat, reply_id, prompt)
+
+        return prompt
+
+    def _remember_prompt(self, chat, message, client=0):
+        """Indexes a message sent by the bot to resolve replies on it locally"""
+
+        if message is None:
+            return
+
+        prompt = Prompt(prompt_kind(message.message), client)
+        self._replies.add(chat, message.id, prompt)
 
     def _init_clients_data(self):
         """Sets the clients data table"""
 
-        rows = []
-        with open(self._settings.path_users(), 'r', encoding='utf-8-sig') as f:
-            lines = f.readlines()
-            for line in lines:
-                data = json.loads(line.replace('\n', ''))
-                rows.append(data)
-
-        if len(rows) > 0:
-            df = DataFrame(rows)
-            df['chatting'] = False
-            df['text'] = ''
-            df['documenting'] = False
+        if self._store.is_empty():
+            self._import_users()
+
+        clients_data = ClientRegistry()
+        self._clients_version = self._store.last_version()
+        self._store.load(clients_data)
+
+        self._clients_data = clients_data
+        self._index_clients()
+
+    def _index_clients(self):
+        """Rebuilds the clients' search index"""
+
+        for record in self._clients_data:
+            self._index_client(record)
+
+    def _index_client(self, record):
+        """Indexes a client's record for the search"""
+
+        description = self._directory.name(record.enterprise) or ''
+        self._clients_index.add(record.id, record.name, record.enterprise, description)
+
+    async def _send_history(self, manager, client, limit=1000):
+        """Sends the client's latest archived messages to the manager as a document"""
+
+        loop = asyncio.get_running_loop()
+        records = await loop.run_in_executor(None, self._archive.history, client, 0.0, limit)
+        if not records:
+            self._send_message(manager, 'Історія звернень клієнта порожня')
+            return
+
+        authors = {'client': 'Клієнт', 'manager': 'Менеджер'}
+        lines = []
+        for record in records:
+            moment = time.strftime('%Y-%m-%d %H:%M', time.localtime(record['time']))
+            line = f'{moment} {authors.get(record["author"], record["author"])} {record["manager"]}: {record["text"]}'
+            if record.get('media'):
+                line += f' [{record["media"]}]'
+            lines.append(line)
+
+        buffer = io.BytesIO('\n'.join(lines).encode('utf-8'))
+        buffer.name = f'history-{client}.txt'
+        caption = f'Клієнт: {client}\nІсторія звернень: {len(records)} повідомлень'
+        self._outbox.send_file(manager, buffer, caption=caption)
+
+    async def _start_broadcast(self, manager, message, target):
+        """Starts broadcasting the message the command replies to, the target is 'all', an enterprise or none"""
+
+        if message.reply_to is None:
+            send_text = 'Надішліть /broadcast у відповідь на повідомлення, яке потрібно розіслати:\n'
+            send_text += '/broadcast - Вашим клієнтам\n'
+            send_text += '/broadcast <код> - клієнтам підприємства\n'
+            send_text += '/broadcast all - усім клієнтам (лише адміністратор)'
+            self._send_message(manager, send_text)
+            return
+
+        clients = self._broadcast_clients(manager, target)
+        if clients is None:
+            self._send_message(manager, 'Розсилку усім клієнтам може запустити лише адміністратор')
+            return
+        if not clients:
+            self._send_message(manager, 'Немає клієнтів для розсилки')
+            return
+
+        source = await self._telegram.get_messages(self._peers.peer(manager), ids=message.reply_to.reply_to_msg_id)
+        if source is None:
+            self._send_message(manager, 'Не вдалося знайти повідомлення для розсилки')
+            return
+
+        broadcast = Broadcast(int(time.time() * 1000), manager, source.id, target or str(manager), clients)
+        self._store.save_broadcast(broadcast)
+        self._run_broadcast(broadcast, source)
+
+    def _broadcast_clients(self, manager, target):
+        """Returns ids of the broadcast's clients, None if the manager may not broadcast to the target"""
+
+        is_admin = manager == self._manager_admin()
+        if target == 'all':
+            if not is_admin:
+                return None
+            records = list(self._clients_data)
+        elif target:
+            try:
+                code = int(target)
+            except ValueError:
+                return []
+            records = [
+                record for record in self._clients_data
+                if record.enterprise == code and (is_admin or record.manager == manager)
+            ]
         else:
-            df = DataFrame(columns=['id', 'name', 'enterprise', 'manager', 'chatting', 'text', 'documenting'])
+            records = self._clients_data.clients_by_manager(manager)
+
+        return sorted(record.id for record in records)
+
+    def _run_broadcast(self, broadcast, source):
+        """Runs a broadcast in the background"""
+
+        task = asyncio.get_running_loop().create_task(self._broadcast(broadcast, source))
+        self._broadcasts[broadcast.id] = task
+        task.add_done_callback(lambda done: self._broadcasts.pop(broadcast.id, None))
 
-        self._clients_data = df
+    async def _broadcast(self, broadcast, source):
+        """Sends a broadcast keeping its manager informed on the progress in one edited message"""
+
+        manager = broadcast.manager
+        try:
+            progress = await self._send_message(manager, self._broadcast_report(broadcast))
+        except Exception:
+            progress = None
+
+        def report(current):
+            if progress is not None:
+                peer = self._peers.peer(manager)
+                text = self._broadcast_report(current)
+                self._outbox.submit(manager, lambda: self._telegram.edit_message(peer, progress, text))
+
+        try:
+            await self._broadcaster.run(broadcast, source, report)
+        except Exception:
+            logging.exception('Broadcast %s failed', broadcast.id)
+            self._send_message(manager, 'Розсилку перервано, її буде продовжено після перезапуску бота')
+            return
+
+        report(broadcast)
+
+    @staticmethod
+    def _broadcast_report(broadcast):
+        """Returns the text of a broadcast's progress"""
+
+        text = f'Розсилка ({broadcast.target}): надіслано {broadcast.sent} з {broadcast.total}'
+        text += f', помилок {broadcast.failed}'
+        if broadcast.done() == broadcast.total:
+            text += ' ✅'
+
+        return text
+
+    async def _resume_broadcasts(self):
+        """Resumes the broadcasts interrupted by the bot's stop"""
+
+        loop = asyncio.get_running_loop()
+        for data in await loop.run_in_executor(None, self._store.load_broadcasts):
+            broadcast = Broadcast(
+                data['id'], data['manager'], data['message_id'], data['target'], data['clients'],
+                data['sent'], data['failed']
+            )
+            source = await self._telegram.get_messages(self._peers.peer(broadcast.manager), ids=broadcast.message_id)
+            if source is None:
+                self._store.finish_broadcast(broadcast.id)
+                self._send_message(broadcast.manager, 'Не вдалося продовжити розсилку: повідомлення не знайдено')
+                continue
+
+            self._run_broadcast(broadcast, source)
+
+    def _start_profile(self, manager, text):
+        """Starts profiling the bot for the seconds given in the command, the result goes to the manager"""
+
+        try:
+            seconds = int(text.replace('/profile', '').strip() or 10)
+        except ValueError:
+            seconds = 10
+        seconds = max(1, min(seconds, 300))
+
+        if self._profiling is not None and not self._profiling.done():
+            self._send_message(manager, 'Профілювання вже запущено')
+            return
+
+        self._send_message(manager, f'Профілювання запущено на {seconds} с')
+        self._profiling = asyncio.get_running_loop().create_task(self._profile(manager, seconds))
+
+    async def _profile(self, manager, seconds):
+        """Profiles the bot and sends the collapsed stacks to the manager as a document"""
+
+        try:
+            report = await self._profiler.profile(seconds)
+        except Exception:
+            logging.exception('Profiling failed')
+            self._send_message(manager, 'Не вдалося виконати профілювання')
+            return
+
+        buffer = io.BytesIO(report['collapsed'].encode('utf-8'))
+        buffer.name = time.strftime('profile-%Y%m%d-%H%M%S.txt')
+        caption = f'Профіль за {report["seconds"]:.1f} с: {report["samples"]} зразків потоків, '
+        caption += f'{report["task_samples"]} зразків задач'
+        self._outbox.send_file(manager, buffer, caption=caption)
+
+    async def _refresh_clients_data(self):
+        """Merges the clients changed in the store since the last load and returns a report on it"""
+
+        started = time.perf_counter()
+        since = self._clients_version
+
+        def read_changes():
+            self._store.flush()
+            return self._store.last_version(), list(self._store.changes(since))
+
+        loop = asyncio.get_running_loop()
+        version, changes = await loop.run_in_executor(None, read_changes)
+
+        added = 0
+        updated = 0
+        clients_data = self._clients_data
+        for data in changes:
+            record = clients_data.record(data['id'])
+            if record is None:
+                self._index_client(clients_data.add(data))
+                added += 1
+                continue
+
+            # The registration is updated, while an open conversation is kept as it is
+            is_updated = False
+            for column in ('name', 'enterprise', 'manager'):
+                if getattr(record, column) != data[column]:
+                    clients_data.set(record.id, column, data[column])
+                    is_updated = True
+            if is_updated:
+                self._index_client(record)
+                updated += 1
+
+        self._clients_version = version
+        kept = len(clients_data) - added - updated
+        seconds = time.perf_counter() - started
+
+        report = f'Клієнти: додано {added}, оновлено {updated}, без змін {kept} за {seconds:.2f} с'
+        logging.info(report)
+
+        return report
+
+    def _import_users(self):
+        """Moves the registrations from the legacy users file to the empty clients store, the file isn't read after that"""
+
+        path_users = self._settings.path_users()
+        if not os.path.exists(path_users):
+            return
+
+        users = ClientRegistry()
+        with open(path_users, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                data = json.loads(line)
+                users.add(data)
+
+        for record in users:
+            self._store.save(record)
+        self._store.flush()
 
     def _client_name(self, client):
         """Returns a client's name."""
@@ -722,36 +1107,73 @@ class Bot:
         if self._is_auth(client):
             return
 
-        with open(self._settings.path_users(), 'a', encoding='utf-8') as f:
-            data = {
-                'id': client,
-                'name': name,
-                'enterprise': code,
-                'manager': manager
-            }
-            str_data = json.dumps(data, ensure_ascii=False) + '\n'
-            f.write(str_data)
-
-        data.update({'chatting': False, 'text': '', 'documenting': False})
-        new_row = DataFrame([data])
-        self._clients_data = self._clients_data.append(new_row)
+        data = {
+            'id': client,
+            'name': name,
+            'enterprise': code,
+            'manager': manager
+        }
+        record = self._clients_data.add(data)
+        self._store.save(record)
+        self._index_client(record)
 
     def _is_auth(self, client):
         """Returns either the client is authorized or not."""
 
-        value = self._get_client_value(client, 'id')
-        is_auth = False if value is None else True
+        is_auth = client in self._clients_data
 
         return is_auth
 
-    def _set_chatting(self, client, is_chatting):
-        """Sets the client as chatting"""
+    def _set_chatting(self, client, is_chatting, hours=default_hours, manager=0):
+        """Sets the client as chatting with the manager, scheduling a response deadline in the given hours"""
 
-        if self._is_chatting(client) == is_chatting:
+        # An unknown client's ticket could never be closed
+        if not self._is_auth(client) or self._is_chatting(client) == is_chatting:
             return
 
         self._set_client_value(client, 'chatting', is_chatting)
 
+        if is_chatting:
+            manager = manager or self._manager_by_ticket(client)
+            self._balancer.open(client, manager)
+            deadline = time.time() + hours * 3600
+            self._sla.schedule(client, deadline)
+            self._store.save_ticket(client, manager, deadline)
+        else:
+            self._balancer.close(client)
+            self._sla.cancel(client)
+            self._store.drop_ticket(client)
+
+    def _init_tickets(self):
+        """Restores the managers, the managers' load and the response deadlines of the open tickets"""
+
+        for client, manager, deadline in self._store.load_tickets():
+            if not self._is_chatting(client):
+                self._store.drop_ticket(client)
+                continue
+            self._balancer.open(client, manager)
+            if deadline is not None:
+                self._sla.schedule(client, deadline)
+
+    async def _escalate(self, client, deadline):
+        """Notifies the default and the admin managers about an overdue ticket"""
+
+        if not self._is_chatting(client):
+            return
+
+        # The ticket stays open on its manager, while its deadline is over
+        manager = self._manager_by_ticket(client)
+        self._store.save_ticket(client, manager, None)
+        logging.warning('Ticket is overdue', extra={'client': client, 'manager': manager, 'route': 'escalation'})
+
+        send_text = 'Клієнт: ' + str(client)
+        send_text += '\nІм\'я: ' + self._client_name(client)
+        send_text += '\nПідприємство: ' + str(self._enterprise_by_client(client))
+        send_text += '\nВідповідальний менеджер: ' + str(manager)
+        send_text += '\nТермін відповіді на звернення минув ⏰'
+        for escalation_manager in {self._manager_by_default(), self._manager_admin()}:
+            self._send_message(escalation_manager, send_text, client)
+
     def _is_chatting(self, client):
         """Returns either the client is chatting or not."""
 
@@ -795,24 +1217,71 @@ class Bot:
     def _set_client_value(self, client, column, value):
         """Updates the clients' data table"""
 
-        df = self._clients_data
-        df.loc[df.id == client, column] = value
+        self._clients_data.set(client, column, value)
+
+        record = self._clients_data.record(client)
+        if record is None:
+            return
+
+        # The conversation state is written alone, so the registrations edited in the store are kept
+        if column in ClientStore.state_columns:
+            self._store.save_state(record)
+        else:
+            self._store.save(record)
 
     def _get_client_value(self, client, column):
         """Returns a column's value from the clients' data table"""
 
-        try:
-            df = self._clients_data
-            value = df.loc[df.id == client, column].values[0]
-        except:
-            value = None
-
-        return value
+        return self._clients_data.get(client, column)
 
-    def _managers(self):
+    async def _managers(self):
         """Returns all the managers."""
 
-        return self._get_managers_from_crm()
+        return await self._get_managers_from_crm()
+
+    async def _warm_up_peers(self):
+        """Resolves the input peers of all the known managers and clients and returns a report on it"""
+
+        users = list(self._managers_data)
+        users += [self._manager_admin(), self._manager_by_default(), self._manager_by_documents()]
+        users += [record.id for record in self._clients_data]
+        stats = await self._peers.warm_up(users)
+
+        report = f'Кеш користувачів: {len(self._peers)} (+{stats["resolved"]}, помилок {stats["failed"]}) ' \
+                 f'за {stats["seconds"]:.2f} с, влучань {self._peers.hit_ratio():.0%}'
+        logging.info(report)
+
+        return report
+
+    def _is_manager_event(self, event):
+        """Returns either the event comes from a manager's chat or not."""
+
+        return event.chat_id in self._managers_data
+
+    async def _refresh_managers(self):
+        """Reloads the managers from CRM and returns a report on it"""
+
+        self._crm_cache.invalidate(('managers', 0))
+        managers = await self._get_managers_from_crm(fallback=False)
+        if not managers:
+            return 'Не вдалося оновити список менеджерів'
+
+        added, removed = self._managers_data.update(managers)
+        report = f'Менеджери: {len(self._managers_data)}, додано {len(added)}, видалено {len(removed)}'
+        logging.info(report)
+
+        return report
+
+    async def _watch_managers(self):
+        """Refreshes the managers from CRM in the background"""
+
+        interval = self._settings.managers_refresh_interval()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._refresh_managers()
+            except Exception:
+                logging.exception('Managers refresh failed')
 
     def _manager_admin(self):
         """Returns admin manager from the settings"""
@@ -829,10 +1298,10 @@ class Bot:
 
         return self._settings.documents_manager()
 
-    def _manager_by_enterprise(self, code):
+    async def _manager_by_enterprise(self, code):
         """Returns an id of manager who is responsible for the given enterprise."""
 
-        managers = self._get_managers_from_crm(code)
+        managers = await self._get_managers_from_crm(code)
         if managers:
             manager = managers[0]
         else:
@@ -850,21 +1319,35 @@ class Bot:
 
         return manager
 
-    def _clients_by_manager(self, manager):
-        """Returns clients' id for the given responsible manager."""
+    def _manager_by_ticket(self, client):
+        """Returns a manager's id who handles the client's open ticket."""
 
-        clients = []
+        manager = self._balancer.manager(client)
+        if not manager:
+            if self._is_documenting(client):
+                manager = self._manager_by_documents()
+            else:
+                manager = self._manager_by_client(client)
+
+        return manager
+
+    async def _manager_by_load(self, client, enterprise):
+        """Returns the least loaded manager's id among the ones responsible for the client's enterprise."""
 
-        df = self._clients_data
-        data = df.loc[df.manager == manager]
-        data = data.sort_values(by=['enterprise', 'name', 'id'])
-        for index, row in data.iterrows():
-            clients.append({'id': row.id, 'name': row[1], 'enterprise': row.enterprise})
+        managers = await self._get_managers_from_crm(enterprise) if enterprise else []
+        manager = self._balancer.choose(managers)
+        if not manager:
+            manager = self._manager_by_client(client)
 
-        return clients
+        return manager
 
-    def _get_managers_from_crm(self, code=0):
-        """Returns filled managers from CRM"""
+    async def _get_managers_from_crm(self, code=0, fallback=True):
+        """Returns filled managers from CRM, the default manager if there are none and `fallback` is set"""
+
+        key = ('managers', code)
+        managers = self._crm_cache.get(key)
+        if managers is not None:
+            return managers
 
         managers = []
         query = """
@@ -872,75 +1355,131 @@ class Bot:
                     FROM [DB].[dbo].[_Reference1111] WITH (NOLOCK)
                     WHERE _Fld1111 > 0
                 """
+        params = ()
         if code:
+            if code in self._directory:
+                managers = self._directory.managers(code)
+                return managers if managers else [self._manager_by_default()]
+
             query += """
                         AND _Code IN(
                             SELECT _Fld1111 AS name
                             FROM [DB].[dbo].[_Reference1111] WITH (NOLOCK)
-                            WHERE _Code = """ + str(code) + ')'
+                            WHERE _Code = ?)
+                    """
+            params = (code,)
 
-        data = self._get_data_from_crm(query)
+        data = await self._get_data_from_crm(query, params, 'managers')
         if data:
             for tg_id in data:
                 managers.append(int(tg_id))
-        else:
+            self._crm_cache.set(key, managers)
+        elif fallback:
             managers.append(self._manager_by_default())
 
         return managers
 
-    def _get_enterprises_from_crm(self):
-        """Returns enterprises from CRM"""
+    async def _get_enterprises_from_crm(self):
+        """Returns a set of enterprises' codes from CRM"""
+
+        if self._directory.is_loaded():
+            return self._directory.enterprises()
 
-        codes = []
+        key = ('enterprises',)
+        codes = self._crm_cache.get(key)
+        if codes is not None:
+            return codes
+
+        codes = set()
         query = """
                     SELECT _Code AS data
                     FROM [DB].[dbo].[_Reference1111] WITH (NOLOCK)
                     WHERE _Fld1111RRef = 0x11111111111111111111111111111111
                 """
-        data = self._get_data_from_crm(query)
+        data = await self._get_data_from_crm(query, kind='enterprises')
         if data:
             for code in data:
-                codes.append(int(code))
+                codes.add(int(code))
+            self._crm_cache.set(key, codes)
         else:
-            codes.append(666)
+            codes.add(666)
 
         return codes
 
-    def _get_enterprise_name_from_crm(self, code):
-        """Returns filled managers from CRM"""
+    async def _get_enterprise_name_from_crm(self, code):
+        """Returns enterprise's names from CRM"""
+
+        name = self._directory.name(code)
+        if name is not None:
+            return [name]
+
+        key = ('names', code)
+        names = self._crm_cache.get(key)
+        if names is not None:
+            return names
 
         names = []
         query = """
                     SELECT _Description AS data
                     FROM [DB].[dbo].[_Reference1111] WITH (NOLOCK)
-                    WHERE _Code = """ + str(code)
-        data = self._get_data_from_crm(query)
+                    WHERE _Code = ?
+                """
+        data = await self._get_data_from_crm(query, (code,), 'names')
         if data:
             for name in data:
                 names.append(name)
+            self._crm_cache.set(key, names)
         else:
             names.append(str(code))
 
         return names
 
-    @staticmethod
-    def _get_data_from_crm(query):
-        data = []
+    async def _load_directory(self):
+        """Loads the CRM directory snapshot and returns a report on it"""
+
+        try:
+            stats = await self._directory.load(self._crm)
+        except Exception as e:
+            logging.warning('CRM directory load failed: %r', e)
+            return 'Не вдалося завантажити довідник підприємств'
+
+        report = f'Довідник підприємств: {stats["size"]} записів за {stats["seconds"]:.2f} с'
+        logging.info(report)
+        self._index_clients()
+
+        return report
+
+    async def _get_data_from_crm(self, query, params=(), kind='other'):
+        """Returns the first column of a CRM query without blocking the event loop"""
 
         try:
-            server = 'server'
-            db = 'db'
-            user = 'user'
-            pw = 'password'
-
-            url = 'DRIVER={ODBC Driver 13 for SQL Server};' + f'SERVER={server};DATABASE={db};UID={user};PWD={pw}'
-            connection = pyodbc.connect(url)
-            cursor = connection.cursor()
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            for row in rows:
-                data.append(row.data)
-        except:
+            data = await self._crm.fetch_column(query, params, kind=kind)
+        except CrmUnavailable:
+            data = []
+        except Exception as e:
+            logging.warning('CRM query failed: %r', e)
             data = []
 
         return data
+
+    def _init_crm(self):
+        """Returns the CRM access layer"""
+
+        settings = self._settings
+        server = settings.crm_server()
+        db = settings.crm_database()
+        user = settings.crm_user()
+        pw = settings.crm_password()
+        timeout = settings.crm_timeout()
+
+        # The ODBC driver is only needed to reach the real CRM
+        import pyodbc
+
+        url = 'DRIVER={ODBC Driver 13 for SQL Server};' + f'SERVER={server};DATABASE={db};UID={user};PWD={pw}'
+
+        def connect():
+            connection = pyodbc.connect(url, timeout=int(timeout))
+            connection.timeout = int(timeout)
+            return connection
+
+        return Crm(connect, settings.crm_pool_size(), timeout)
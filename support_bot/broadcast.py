@@ -0,0 +1,163 @@
+"""
+Broadcasts of the managers' announcements to many clients
+"""
+
+import asyncio
+import io
+from support_bot import metrics
+from support_bot.media import reference_errors
+
+
+deliveries = metrics.counter('support_bot_broadcast_deliveries_total', 'Broadcast deliveries by status', ('status',))
+
+
+class Broadcast:
+    """A class to represent an announcement to a list of clients."""
+
+    __slots__ = ('id', 'manager', 'message_id', 'target', 'clients', 'sent', 'failed', 'total')
+
+    def __init__(self, id, manager, message_id, target, clients, sent=0, failed=0):
+        self.id = id
+        self.manager = manager
+        self.message_id = message_id
+        self.target = target
+        self.clients = clients
+        self.sent = sent
+        self.failed = failed
+        self.total = sent + failed + len(clients)
+
+    def done(self):
+        return self.sent + self.failed
+
+
+class Broadcaster:
+    """
+    A class to represent the broadcasts' sender.
+
+    Announcements go through the outbox, so its rate limits and FloodWait handling
+    apply, while at most `concurrency` sends of a broadcast are queued at once, so
+    the conversations aren't stuck behind it. The announcement's media is sent by
+    its Telegram reference, and if Telegram refuses the reference, the media is
+    downloaded and uploaded once. Either way the rest of the clients get the file
+    of the first delivered message. Every delivery is saved to the store, so an
+    interrupted broadcast resumes with the clients not reached yet.
+
+    Methods
+    -------
+    run(broadcast, message, report) : None
+        Sends the message to the broadcast's clients, calling `report(broadcast)` on progress
+    """
+
+    def __init__(self, telegram, outbox, store, resolve=None, concurrency=8, progress_interval=5.0):
+        self._telegram = telegram
+        self._outbox = outbox
+        self._store = store
+        self._resolve = (lambda chat: chat) if resolve is None else resolve
+        self._concurrency = concurrency
+        self._progress_interval = progress_interval
+
+    async def run(self, broadcast, message, report=None):
+        text = message.message or ''
+        media = None
+        if message.photo is not None or message.document is not None:
+            media = message.media
+
+        progress = None
+        if report is not None:
+            progress = asyncio.get_running_loop().create_task(self._report_progress(broadcast, report))
+        try:
+            clients = broadcast.clients
+            first = 0
+            if media is not None:
+                media, first = await self._settle_media(broadcast, message, text, media)
+
+            semaphore = asyncio.Semaphore(self._concurrency)
+
+            async def deliver(client):
+                async with semaphore:
+                    await self._deliver(broadcast, client, text, media)
+
+            await asyncio.gather(*(deliver(client) for client in clients[first:]))
+        finally:
+            if progress is not None:
+                progress.cancel()
+
+        self._store.finish_broadcast(broadcast.id)
+
+    async def _settle_media(self, broadcast, message, text, media):
+        """Sends to the clients one by one till a send succeeds, returns the media to reuse and the next client's index"""
+
+        clients = broadcast.clients
+        index = 0
+        is_uploaded = False
+        while index < len(clients):
+            client = clients[index]
+            try:
+                sent = await self._send(client, text, media)
+            except reference_errors:
+                if not is_uploaded:
+                    # The reference is refused, the media is uploaded from a buffer instead
+                    media = await self._download(message)
+                    is_uploaded = True
+                    continue
+                self._record(broadcast, client, 'failed')
+            except Exception:
+                self._record(broadcast, client, 'failed')
+            else:
+                self._record(broadcast, client, 'sent')
+                if getattr(sent, 'media', None) is not None:
+                    return sent.media, index + 1
+            index += 1
+
+        return media, index
+
+    async def _download(self, message):
+        buffer = io.BytesIO()
+        await self._telegram.download_media(message, buffer)
+        buffer.seek(0)
+        buffer.name = message.file.name or 'file' + (message.file.ext or '')
+
+        return buffer
+
+    async def _deliver(self, broadcast, client, text, media):
+        def record(done):
+            is_sent = not done.cancelled() and done.exception() is None
+            self._record(broadcast, client, 'sent' if is_sent else 'failed')
+
+        # A queued send is recorded even if the broadcast is cancelled meanwhile, so it isn't repeated on resume
+        future = self._send(client, text, media)
+        future.add_done_callback(record)
+        try:
+            await asyncio.shield(future)
+        except Exception:
+            pass
+
+    def _send(self, client, text, media):
+        if isinstance(media, io.BytesIO):
+            # Concurrent uploads can't share the buffer's position
+            name = media.name
+            media = io.BytesIO(media.getvalue())
+            media.name = name
+        if media is None:
+            return self._outbox.submit(client, lambda: self._telegram.send_message(self._resolve(client), text))
+
+        return self._outbox.submit(
+            client, lambda: self._telegram.send_file(self._resolve(client), media, caption=text)
+        )
+
+    def _record(self, broadcast, client, status):
+        # Failures are logged by the outbox
+        if status == 'sent':
+            broadcast.sent += 1
+        else:
+            broadcast.failed += 1
+        deliveries.inc(status)
+        self._store.save_delivery(broadcast.id, client, status)
+
+    async def _report_progress(self, broadcast, report):
+        reported = -1
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            if broadcast.done() != reported:
+                reported = broadcast.done()
+                report(broadcast)
@@ -0,0 +1,65 @@
+"""
+Size-bounded cache with a time-to-live
+"""
+
+import time
+from collections import OrderedDict
+
+
+class TtlCache:
+    """
+    A class to represent a read-through cache, e.g. for the CRM lookups.
+
+    Entries expire `ttl` seconds after they were set; when the cache is full
+    the least recently used entry is evicted. With `weigh` given, the cache is
+    also bounded by the total weight of its values, e.g. their size in bytes.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0, clock=time.monotonic, maxweight=None, weigh=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        self._maxweight = maxweight
+        self._weigh = weigh
+        self._data = OrderedDict()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Returns a cached value or `default` if it's missing or expired."""
+
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires, value = entry
+        if expires <= self._clock():
+            self.invalidate(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.invalidate(key)
+        if self._weigh is not None:
+            self.weight += self._weigh(value)
+        self._data[key] = (self._clock() + self._ttl, value)
+        while len(self._data) > self._maxsize or self._maxweight is not None and self.weight > self._maxweight:
+            self.invalidate(next(iter(self._data)))
+
+    def invalidate(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None and self._weigh is not None:
+            self.weight -= self._weigh(entry[1])
+
+    def clear(self):
+        self._data.clear()
+        self.weight = 0
@@ -0,0 +1,134 @@
+"""
+In-memory registry of the bot's clients
+"""
+
+
+class ClientRecord:
+    """A class to represent a single registered client."""
+
+    __slots__ = ('id', 'name', 'enterprise', 'manager', 'chatting', 'text', 'documenting')
+
+    def __init__(self, id, name='', enterprise=0, manager=0, chatting=False, text='', documenting=False):
+        self.id = id
+        self.name = name
+        self.enterprise = enterprise
+        self.manager = manager
+        self.chatting = chatting
+        self.text = text
+        self.documenting = documenting
+
+
+class ClientRegistry:
+    """
+    A class to represent the clients' data table keyed by a Telegram user id.
+
+    Methods
+    -------
+    get(client, column) : object
+        Returns a column's value or None if the client or the column is unknown
+    set(client, column, value) : None
+        Updates a column's value of a known client
+    add(data) : ClientRecord
+        Adds a client from a dict with the record's columns
+    clients_by_manager(manager) : list
+        Returns records of the clients the given manager is responsible for
+    ids_by_manager(manager) : set
+        Returns ids of the clients the given manager is responsible for, the set mustn't be changed
+    version(manager) : int
+        Returns a number that changes whenever the manager's clients are added, removed or renamed
+    """
+
+    columns = ClientRecord.__slots__
+
+    def __init__(self):
+        self._records = {}
+        self._by_manager = {}
+        self._versions = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __contains__(self, client):
+        return client in self._records
+
+    def record(self, client):
+        """Returns the client's record or None."""
+
+        return self._records.get(client)
+
+    def add(self, data):
+        """Adds (or replaces) a client's record."""
+
+        values = {column: data[column] for column in self.columns if column in data}
+        record = ClientRecord(**values)
+        self.remove(record.id)
+        self._records[record.id] = record
+        self._by_manager.setdefault(record.manager, set()).add(record.id)
+        self._touch(record.manager)
+
+        return record
+
+    def remove(self, client):
+        """Removes a client's record if it exists."""
+
+        record = self._records.pop(client, None)
+        if record is not None:
+            self._unindex(record)
+
+        return record
+
+    def get(self, client, column):
+        """Returns a column's value from the clients' data table"""
+
+        record = self._records.get(client)
+        if record is None or column not in self.columns:
+            return None
+
+        return getattr(record, column)
+
+    def set(self, client, column, value):
+        """Updates the clients' data table"""
+
+        record = self._records.get(client)
+        if record is None or column not in self.columns or column == 'id':
+            return
+
+        if column == 'manager':
+            self._unindex(record)
+            record.manager = value
+            self._by_manager.setdefault(value, set()).add(record.id)
+            self._touch(value)
+        else:
+            setattr(record, column, value)
+            if column in ('name', 'enterprise'):
+                self._touch(record.manager)
+
+    def clients_by_manager(self, manager):
+        """Returns records of the clients for the given responsible manager."""
+
+        ids = self._by_manager.get(manager, ())
+        return [self._records[client] for client in ids]
+
+    def ids_by_manager(self, manager):
+        """Returns ids of the clients for the given responsible manager."""
+
+        return self._by_manager.get(manager, frozenset())
+
+    def version(self, manager):
+        return self._versions.get(manager, 0)
+
+    def _touch(self, manager):
+        self._versions[manager] = self._versions.get(manager, 0) + 1
+
+    def _unindex(self, record):
+        ids = self._by_manager.get(record.manager)
+        if ids is None:
+            return
+
+        self._touch(record.manager)
+        ids.discard(record.id)
+        if not ids:
+            del self._by_manager[record.manager]
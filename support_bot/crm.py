@@ -0,0 +1,205 @@
+"""
+Pooled, non-blocking access to the CRM database
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from support_bot import metrics
+
+
+crm_queries = metrics.counter('support_bot_crm_queries_total', 'CRM queries by kind and status', ('kind', 'status'))
+crm_latency = metrics.histogram('support_bot_crm_query_seconds', 'CRM query latency', ('kind',))
+
+
+class CrmUnavailable(Exception):
+    """Raised when the CRM is not queried because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    A class to represent a circuit breaker around the CRM.
+
+    After `threshold` failures in a row the circuit opens and every call is refused
+    for `reset_timeout` seconds, then a single trial call is let through.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=30.0):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        """Returns either a call may go to the CRM or not."""
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self._reset_timeout:
+                # Half-open: let one trial call through and wait for its result
+                self._opened_at = time.monotonic()
+                return True
+
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._threshold:
+                self._opened_at = time.monotonic()
+
+
+class ConnectionPool:
+    """A class to represent a bounded pool of DB-API connections."""
+
+    def __init__(self, connect, size=4):
+        self._connect = connect
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """Returns an idle connection, opening a new one while the pool isn't full."""
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self._size
+            if can_create:
+                self._created += 1
+
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('No free CRM connection in the pool')
+
+    def release(self, connection, broken=False):
+        """Returns a connection to the pool or drops it if it's broken."""
+
+        if broken:
+            with self._lock:
+                self._created -= 1
+            self._close(connection)
+        else:
+            self._idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+class Crm:
+    """
+    A class to represent the CRM access layer.
+
+    Queries run on a worker thread pool over pooled connections, so the event loop
+    is never blocked by the database. Any DB-API driver works through `connect`,
+    e.g. pyodbc for SQL Server or sqlite3 in tests.
+
+    Methods
+    -------
+    fetch_rows(query, params, timeout, kind) : list
+        Returns all the rows of a query, `kind` labels it in the metrics
+    fetch_column(query, params, timeout, kind) : list
+        Returns the first column of all the rows of a query
+    close() : None
+        Closes the pool and the workers
+    """
+
+    def __init__(self, connect, pool_size=4, timeout=10.0, breaker=None):
+        self._pool = ConnectionPool(connect, pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='crm')
+        self._timeout = timeout
+        self._breaker = CircuitBreaker() if breaker is None else breaker
+
+    @property
+    def breaker(self):
+        return self._breaker
+
+    async def fetch_rows(self, query, params=(), timeout=None, kind='other'):
+        if not self._breaker.allow():
+            crm_queries.inc(kind, 'rejected')
+            raise CrmUnavailable('CRM circuit is open')
+
+        timeout = self._timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        future = loop.run_in_executor(self._executor, self._execute, query, tuple(params), timeout)
+        try:
+            rows = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._breaker.failure()
+            crm_queries.inc(kind, 'timeout')
+            raise
+        except Exception:
+            self._breaker.failure()
+            crm_queries.inc(kind, 'error')
+            raise
+        finally:
+            crm_latency.observe(time.perf_counter() - started, kind)
+
+        self._breaker.success()
+        crm_queries.inc(kind, 'ok')
+        return rows
+
+    async def fetch_column(self, query, params=(), timeout=None, kind='other'):
+        rows = await self.fetch_rows(query, params, timeout, kind)
+        return [row[0] for row in rows]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._pool.close()
+
+    def _execute(self, query, params, timeout):
+        connection = self._pool.acquire(timeout)
+        broken = False
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, params)
+            rows = [tuple(row) for row in cursor.fetchall()]
+            cursor.close()
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._pool.release(connection, broken)
+
+        return rows
@@ -0,0 +1,95 @@
+"""
+In-memory snapshot of the CRM enterprises directory
+"""
+
+import time
+
+
+class Enterprise:
+    """A class to represent an enterprise of the directory."""
+
+    __slots__ = ('code', 'name', 'managers')
+
+    def __init__(self, code, name):
+        self.code = code
+        self.name = name
+        self.managers = []
+
+
+class Directory:
+    """
+    A class to represent the enterprise -> manager -> name directory.
+
+    The whole directory is pulled from CRM in one query and swapped in at once,
+    so the lookups never see a half-loaded snapshot.
+
+    Methods
+    -------
+    load(crm) : dict
+        Loads a new snapshot and returns its size and load time
+    enterprises() : set
+        Returns all the enterprises' codes
+    name(code) : str
+        Returns an enterprise's description
+    managers(code) : list
+        Returns Telegram ids of the enterprise's responsible managers
+    """
+
+    query = """
+                SELECT e._Code AS code, e._Description AS name, m._Fld1111 AS manager
+                FROM [DB].[dbo].[_Reference1111] e WITH (NOLOCK)
+                LEFT JOIN [DB].[dbo].[_Reference1111] m WITH (NOLOCK)
+                    ON m._Code = e._Fld1111 AND m._Fld1111 > 0
+                WHERE e._Fld1111RRef = ?
+            """
+    enterprise_ref = bytes.fromhex('11111111111111111111111111111111')
+
+    def __init__(self):
+        self._enterprises = {}
+        self._codes = frozenset()
+        self._loaded = False
+        self.size = 0
+        self.load_time = 0.0
+
+    def __contains__(self, code):
+        return code in self._enterprises
+
+    def is_loaded(self):
+        return self._loaded
+
+    async def load(self, crm):
+        """Loads the directory snapshot from CRM."""
+
+        started = time.perf_counter()
+        rows = await crm.fetch_rows(self.query, (self.enterprise_ref,), kind='directory')
+
+        enterprises = {}
+        for code, name, manager in rows:
+            code = int(code)
+            enterprise = enterprises.get(code)
+            if enterprise is None:
+                enterprise = Enterprise(code, name)
+                enterprises[code] = enterprise
+            if manager:
+                manager = int(manager)
+                if manager not in enterprise.managers:
+                    enterprise.managers.append(manager)
+
+        self._enterprises = enterprises
+        self._codes = frozenset(enterprises)
+        self._loaded = True
+        self.size = len(enterprises)
+        self.load_time = time.perf_counter() - started
+
+        return {'size': self.size, 'seconds': self.load_time}
+
+    def enterprises(self):
+        return self._codes
+
+    def name(self, code):
+        enterprise = self._enterprises.get(code)
+        return None if enterprise is None else enterprise.name
+
+    def managers(self, code):
+        enterprise = self._enterprises.get(code)
+        return [] if enterprise is None else list(enterprise.managers)
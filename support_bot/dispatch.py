@@ -0,0 +1,55 @@
+"""
+Dispatcher of incoming events with per-key ordering
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+
+class KeyedDispatcher:
+    """
+    A class to represent a dispatcher of events to a handler.
+
+    Events of one key (e.g. one client) are handled one by one in arrival order,
+    while events of different keys are handled concurrently up to `concurrency`.
+    A key's queue and worker are dropped as soon as the queue is drained.
+
+    Methods
+    -------
+    dispatch(key, event) : None
+        Queues an event to be handled
+    """
+
+    def __init__(self, handler, concurrency=64):
+        self._handler = handler
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queues = {}
+        self._workers = {}
+
+    def __len__(self):
+        return len(self._queues)
+
+    def dispatch(self, key, event):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = deque()
+            self._queues[key] = queue
+        queue.append(event)
+
+        if key not in self._workers:
+            self._workers[key] = asyncio.get_running_loop().create_task(self._work(key))
+
+    async def _work(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                event = queue.popleft()
+                async with self._semaphore:
+                    try:
+                        await self._handler(event)
+                    except Exception:
+                        logging.exception('Handling an event of %s failed', key)
+        finally:
+            del self._queues[key]
+            del self._workers[key]
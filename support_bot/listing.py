@@ -0,0 +1,43 @@
+"""
+Cached pages of the managers' client lists
+"""
+
+
+class ClientListing:
+    """
+    A class to represent the managers' client lists split into pages.
+
+    A manager's pages are rendered by `render(records, page, pages)` on the first
+    request and reused until the registry's version of that manager changes, so
+    a list is rendered once per change of the manager's clients, not per request.
+
+    Methods
+    -------
+    page(manager, page) : object
+        Returns a rendered page of the manager's clients, the nearest existing one if it's out of range
+    """
+
+    def __init__(self, registry, render, page_size=20):
+        self._registry = registry
+        self._render = render
+        self._page_size = page_size
+        self._pages = {}
+
+    def page(self, manager, page):
+        version = self._registry.version(manager)
+        cached = self._pages.get(manager)
+        if cached is None or cached[0] != version:
+            cached = (version, self._render_pages(manager))
+            self._pages[manager] = cached
+
+        pages = cached[1]
+        return pages[max(0, min(page, len(pages) - 1))]
+
+    def _render_pages(self, manager):
+        records = self._registry.clients_by_manager(manager)
+        records.sort(key=lambda record: (record.enterprise, record.name, record.id))
+
+        size = self._page_size
+        chunks = [records[i:i + size] for i in range(0, len(records), size)] or [[]]
+
+        return [self._render(chunk, number, len(chunks)) for number, chunk in enumerate(chunks)]
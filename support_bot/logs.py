@@ -0,0 +1,195 @@
+"""
+Non-blocking, batched logging of the bot
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from support_bot import metrics
+
+
+dropped_records = metrics.counter('support_bot_log_records_dropped_total', 'Log records dropped under overload')
+
+# Attributes every record has, the rest came with `extra`
+_standard_attributes = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """A class to represent a formatter of records as JSON lines, `extra` fields included."""
+
+    def format(self, record):
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in record.__dict__.items():
+            if name not in _standard_attributes:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A class to represent a handler passing records to a bounded queue without waiting.
+
+    Once the queue is half full, records below WARNING are dropped, and when it's
+    full every record is dropped, so the caller is never blocked by the writer.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self._shed_size = records.maxsize // 2
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The record crosses threads, so it's made self-contained here
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self._shed_size:
+            self._drop()
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+    def _drop(self):
+        self.dropped += 1
+        dropped_records.inc()
+
+
+class RotatingWriter:
+    """A class to represent a log file rotated by size, as `path`, `path.1`, ... `path.N`."""
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, lines):
+        self._file.write(''.join(lines))
+        self._file.flush()
+        if self._max_bytes and self._file.tell() >= self._max_bytes:
+            self._rotate()
+
+    def close(self):
+        self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self._backups - 1, 0, -1):
+            source = f'{self._path}.{i}'
+            if os.path.exists(source):
+                os.replace(source, f'{self._path}.{i + 1}')
+        if self._backups:
+            os.replace(self._path, self._path + '.1')
+        else:
+            os.remove(self._path)
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+
+class LogPipeline:
+    """
+    A class to represent the logging pipeline.
+
+    Records are put to a bounded queue by the handler and written by a background
+    thread in batches of up to `batch` records, at least every `flush_interval`
+    seconds, to a file rotated by size.
+
+    Methods
+    -------
+    handler : logging.Handler
+        The handler to attach to a logger
+    stop() : None
+        Writes the queued records and stops the writer
+    """
+
+    def __init__(self, path, formatter, max_bytes=10 * 1024 * 1024, backups=5, queue_size=10000, batch=500,
+                 flush_interval=0.5):
+        self._records = queue.Queue(queue_size)
+        self._formatter = formatter
+        self._writer = RotatingWriter(path, max_bytes, backups)
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._reported_drops = 0
+        self._closed = False
+        self.handler = DroppingQueueHandler(self._records)
+
+        self._thread = threading.Thread(target=self._write_loop, name='logs', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._closed = True
+        self._thread.join()
+        self._writer.close()
+
+    def _write_loop(self):
+        while True:
+            records = self._take_batch()
+            lines = [self._formatter.format(record) + '\n' for record in records]
+
+            dropped = self.handler.dropped
+            if dropped != self._reported_drops:
+                record = logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f'{dropped - self._reported_drops} log records dropped under overload',
+                })
+                lines.append(self._formatter.format(record) + '\n')
+                self._reported_drops = dropped
+
+            if lines:
+                try:
+                    self._writer.write(lines)
+                except OSError:
+                    # Logging mustn't break the bot, the batch is lost
+                    pass
+            if self._closed and self._records.empty():
+                return
+
+    def _take_batch(self):
+        records = []
+        deadline = time.monotonic() + self._flush_interval
+        while len(records) < self._batch:
+            timeout = deadline - time.monotonic()
+            try:
+                records.append(self._records.get(timeout=max(timeout, 0)))
+            except queue.Empty:
+                break
+
+        return records
+
+
+def setup(path, json_lines=False, level=logging.WARNING, max_bytes=10 * 1024 * 1024, backups=5, queue_size=10000):
+    """Routes the root logger through a logging pipeline to a file and returns the pipeline"""
+
+    if json_lines:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s')
+    pipeline = LogPipeline(path, formatter, max_bytes, backups, queue_size)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(pipeline.handler)
+
+    return pipeline
@@ -0,0 +1,33 @@
+"""
+Registry of the bot's managers
+"""
+
+
+class ManagerRegistry:
+    """
+    A class to represent the set of managers' Telegram ids.
+
+    The set is immutable and replaced as a whole on update, so a lookup
+    always sees either the old or the new managers, never a mix of them.
+    """
+
+    def __init__(self, managers=()):
+        self._managers = frozenset(managers)
+
+    def __contains__(self, user):
+        return user in self._managers
+
+    def __iter__(self):
+        return iter(self._managers)
+
+    def __len__(self):
+        return len(self._managers)
+
+    def update(self, managers):
+        """Replaces the managers and returns the added and the removed ones."""
+
+        new_managers = frozenset(managers)
+        old_managers = self._managers
+        self._managers = new_managers
+
+        return new_managers - old_managers, old_managers - new_managers
@@ -0,0 +1,266 @@
+"""
+Relay of media between the clients' and the managers' chats
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import time
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError, FileReferenceEmptyError, \
+    FileIdInvalidError, MediaInvalidError, MediaEmptyError
+from support_bot import metrics
+from support_bot.cache import TtlCache
+
+
+relays = metrics.counter('support_bot_media_relays_total', 'Media relays by mode', ('mode',))
+relay_bytes = metrics.counter('support_bot_media_relay_bytes_total', 'Bytes downloaded to relay media by mode', ('mode',))
+cache_lookups = metrics.counter(
+    'support_bot_media_cache_lookups_total', 'Media cache lookups by kind and result', ('kind', 'result')
+)
+cache_bytes = metrics.gauge('support_bot_media_cache_bytes', 'Bytes of the media contents cached')
+
+# Errors of a file's reference or handle refused by Telegram, the file is uploaded instead
+reference_errors = (
+    FileReferenceExpiredError, FileReferenceInvalidError, FileReferenceEmptyError,
+    FileIdInvalidError, MediaInvalidError, MediaEmptyError,
+)
+
+
+def media_key(message):
+    """Returns the Telegram id of a message's photo or document as a cache key, None if it's unknown"""
+
+    for kind in ('photo', 'document'):
+        media_id = getattr(getattr(message, kind), 'id', None)
+        if media_id is not None:
+            return kind, media_id
+
+    return None
+
+
+def content_key(data):
+    """Returns the content hash of a file as a cache key"""
+
+    return 'sha256', hashlib.sha256(data).hexdigest()
+
+
+class MediaCache:
+    """
+    A class to represent the content-addressed cache of the relayed media.
+
+    Files are addressed by their Telegram photo or document id, and by the hash
+    of their content once downloaded. For every destination chat the cache keeps
+    the handle (the media of the bot's sent message) a file was uploaded as, so
+    a repeat is sent by the handle with neither a download nor an upload. The
+    downloaded contents are kept too, so a file is downloaded once for all the
+    destinations. Entries expire after `max_age` seconds, and the contents are
+    bounded by `max_bytes` in total.
+
+    Methods
+    -------
+    handle(chat, key) : object
+        Returns the handle a file was uploaded as to a chat or None
+    remember(chat, keys, handle) : None
+        Keeps the handle a file was uploaded as to a chat under all of its keys
+    forget(chat, key) : None
+        Drops a handle Telegram doesn't accept anymore
+    content(key) : bytes
+        Returns the downloaded content of a file or None
+    store(key, data) : None
+        Keeps the downloaded content of a file
+    stats() : dict
+        Returns the hit ratios of the handles and the contents
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_age=24 * 3600.0, max_handles=10000, clock=time.monotonic):
+        self._handles = TtlCache(max_handles, max_age, clock)
+        self._contents = TtlCache(max_handles, max_age, clock, maxweight=max_bytes, weigh=len)
+
+    def handle(self, chat, key):
+        if key is None:
+            return None
+
+        handle = self._handles.get((chat, key))
+        cache_lookups.inc('handle', 'miss' if handle is None else 'hit')
+        return handle
+
+    def remember(self, chat, keys, handle):
+        for key in keys:
+            if key is not None:
+                self._handles.set((chat, key), handle)
+
+    def forget(self, chat, key):
+        self._handles.invalidate((chat, key))
+
+    def content(self, key):
+        if key is None:
+            return None
+
+        data = self._contents.get(key)
+        cache_lookups.inc('content', 'miss' if data is None else 'hit')
+        return data
+
+    def store(self, key, data):
+        if key is not None:
+            self._contents.set(key, data)
+            cache_bytes.set(self._contents.weight)
+
+    def stats(self):
+        stats = {}
+        for kind, cache in (('handles', self._handles), ('contents', self._contents)):
+            lookups = cache.hits + cache.misses
+            stats[kind] = len(cache)
+            stats[kind + '_hit_ratio'] = cache.hits / lookups if lookups else 0.0
+        stats['contents_bytes'] = self._contents.weight
+
+        return stats
+
+
+class MediaRelay:
+    """
+    A class to represent the media relay.
+
+    A media is re-sent by its Telegram file reference, so nothing is downloaded.
+    If Telegram refuses the reference, the file is streamed through a memory buffer,
+    and only files larger than `max_buffer` bytes are spilled to the disk. An album
+    is sent as one grouped message, and its files are downloaded concurrently.
+    With a `cache`, a file already uploaded to a chat is re-sent by its handle,
+    and a file already downloaded isn't downloaded again.
+
+    Methods
+    -------
+    relay(to, message, caption, chat) : Message
+        Sends the message's media to a chat (`to` is its peer), returns None if the message has no media
+    relay_album(to, messages, caption) : list
+        Sends the messages' media to a chat as one album captioned once
+    """
+
+    def __init__(self, telegram, path_media, max_buffer=20 * 1024 * 1024, cache=None):
+        self._telegram = telegram
+        self._path_media = path_media
+        self._max_buffer = max_buffer
+        self._cache = cache
+
+    async def relay(self, to, message, caption='', chat=None):
+        if message.photo is None and message.document is None:
+            return None
+
+        chat = to if chat is None else chat
+        key = media_key(message)
+        sent = await self._send_cached(to, chat, key, caption)
+        if sent is not None:
+            return sent
+
+        try:
+            sent = await self._telegram.send_file(to, message.media, caption=caption)
+        except reference_errors:
+            pass
+        else:
+            relays.inc('reference')
+            return sent
+
+        file = await self._download(message)
+        if not file:
+            return None
+
+        keys = [key]
+        if isinstance(file, io.BytesIO) and self._cache is not None:
+            # The same content may come as another file, e.g. a screenshot sent again,
+            # it's hashed off the event loop as the buffer may be large
+            loop = asyncio.get_running_loop()
+            with file.getbuffer() as data:
+                keys.append(await loop.run_in_executor(None, content_key, data))
+            sent = await self._send_cached(to, chat, keys[-1], caption)
+            if sent is not None:
+                self._cache.remember(chat, keys, sent.media)
+                return sent
+
+        try:
+            sent = await self._telegram.send_file(to, file, caption=caption)
+        finally:
+            await self._remove([file])
+
+        if self._cache is not None and getattr(sent, 'media', None) is not None:
+            self._cache.remember(chat, keys, sent.media)
+
+        return sent
+
+    async def _send_cached(self, to, chat, key, caption):
+        """Sends a file by the handle it was uploaded as to the chat, returns None if there's none"""
+
+        if self._cache is None:
+            return None
+
+        handle = self._cache.handle(chat, key)
+        if handle is None:
+            return None
+
+        try:
+            sent = await self._telegram.send_file(to, handle, caption=caption)
+        except reference_errors:
+            self._cache.forget(chat, key)
+            return None
+
+        relays.inc('cached')
+        return sent
+
+    async def relay_album(self, to, messages, caption=''):
+        messages = [message for message in messages if message.photo is not None or message.document is not None]
+        if not messages:
+            return []
+
+        try:
+            sent = await self._telegram.send_file(to, [message.media for message in messages], caption=caption)
+        except reference_errors:
+            pass
+        else:
+            relays.inc('reference', value=len(messages))
+            return sent if isinstance(sent, list) else [sent]
+
+        files = await asyncio.gather(*(self._download(message) for message in messages))
+        files = [file for file in files if file]
+        try:
+            sent = await self._telegram.send_file(to, files, caption=caption)
+        finally:
+            await self._remove(files)
+
+        return sent if isinstance(sent, list) else [sent]
+
+    async def _download(self, message):
+        """Downloads a message's media to a buffer or, if it's too large, to a file and returns it"""
+
+        name = message.file.name or 'file' + (message.file.ext or '')
+        key = media_key(message)
+        if self._cache is not None:
+            data = self._cache.content(key)
+            if data is not None:
+                buffer = io.BytesIO(data)
+                buffer.name = name
+                return buffer
+
+        size = message.file.size
+        mode = 'buffer' if size is not None and size <= self._max_buffer else 'disk'
+        relays.inc(mode)
+        relay_bytes.inc(mode, value=size or 0)
+
+        if mode == 'buffer':
+            buffer = io.BytesIO()
+            await self._telegram.download_media(message, buffer)
+            buffer.seek(0)
+            buffer.name = name
+            if self._cache is not None:
+                self._cache.store(key, buffer.getvalue())
+            return buffer
+
+        filepath = self._path_media(message.peer_id.user_id)
+        return await self._telegram.download_media(message, filepath)
+
+    @staticmethod
+    async def _remove(files):
+        """Removes the files spilled to the disk"""
+
+        filepaths = [file for file in files if isinstance(file, str)]
+        if filepaths:
+            loop = asyncio.get_running_loop()
+            for filepath in filepaths:
+                await loop.run_in_executor(None, os.remove, filepath)
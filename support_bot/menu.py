@@ -0,0 +1,364 @@
+"""
+Client's menu of the bot: options, replies and keyboards
+"""
+
+from telethon import Button
+
+
+# Global options
+option_back = '⤴ Головне меню'
+option_comment = '⁉ Звернутись'
+option_ask = '⁉ Запитати'
+
+# Main menu
+option_goods = '💊 Товари'
+option_pharmacies = '🏥 Аптеки'
+option_documents = '📑 Документи'
+option_reports = '📈 Звіти'
+option_defects = '🛠 Технічний збій'
+
+# Goods menu
+option_goods_find = '🔎 Товар не відображається'
+option_goods_add = '📥 Додати новий товар'
+option_goods_link = '🪢 Змінити прив\'язку товара'
+
+# Pharmacies menu
+option_pharmacies_find = '🔎 Аптека не відображається'
+option_pharmacies_reply = '🔄 Відповідь на звернення'
+option_pharmacies_add = '🏥 Додати нову аптеку'
+option_pharmacies_schedule = '📆 Змінити графік'
+option_pharmacies_phone = '☎ Змінити номер'
+option_pharmacies_map = '🗺 Змінити точку'
+option_pharmacies_name = '🆕 Змінити назву'
+option_pharmacies_disable = '🚫 Відключити аптеку'
+option_pharmacies_stop = '❌ Відключити мережу'
+option_pharmacies_client = '📞 Номер клієнта'
+
+# Documents menu
+option_documents_contracts = '📜 Договори'
+option_documents_invoices = '🧾 Рахунки'
+option_documents_acts = '📇 Акти'
+option_documents_contact = '👤 Змінити контактну особу'
+
+# Reports menu
+option_reports_link = '🪢 Товари без прив\'язки'
+option_reports_quality = '📈 Якість'
+option_reports_competitors = '🗺 Оточення'
+option_reports_finance = '💰 Фінанси'
+
+# Defects menu
+option_defects_account = '🖥 Особистий кабінет'
+option_defects_orders = '🛒 Замовлення'
+option_defects_rests = '📦 Залишки'
+
+# Common text
+text_default = 'Оберіть, будь ласка, розділ, користуючись кнопками нижче 👇'
+text_auth = 'Для початку роботи необхідно авторизуватись.\n' \
+            'Введіть код підприємства 👇'
+text_comment = 'Будь ласка, напишіть Ваше звернення 🖌'
+text_ask = 'Попередження!\n' \
+           'Якщо звернутись до менеджера без вибору типу запитання, ' \
+           'Ваше звернення може оброблятися більш тривалий термін (до 48 годин).\n' + text_comment
+text_manager = 'Якщо Ви не знайшли відповідь на своє запитання, звертайтесь до менеджера:\n' \
+               'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. ' \
+               'Менеджер зв\'яжеться з вами в найкоротший термін 👇'
+
+# Default response time of a comment, hours
+default_hours = 48
+
+
+class Route:
+    """
+    A class to represent a menu option's response.
+
+    Attributes
+    ----------
+    text : str
+        Reply text, the default one if None
+    keyboard : list
+        Reply keyboard, the comment one if None
+    hours : int
+        Response time of a comment on the option's topic
+    documenting : bool
+        Sets the client's documents request if not None
+    """
+
+    __slots__ = ('text', 'keyboard', 'hours', 'documenting')
+
+    def __init__(self, text=None, keyboard=None, hours=default_hours, documenting=None):
+        self.text = text
+        self.keyboard = keyboard
+        self.hours = hours
+        self.documenting = documenting
+
+
+class Menu:
+    """
+    A class to represent the client's menu.
+
+    All the keyboards are built once, and every option is dispatched with a single dict lookup.
+
+    Methods
+    -------
+    route(text) : Route
+        Returns the route of a client's input or None if it's not an option
+    hours(topic) : int
+        Returns response time of a comment on the given topic
+    """
+
+    def __init__(self):
+        menu_back = Button.text(option_back, resize=True)
+        self.menu_comment = [Button.text(option_comment, resize=True), menu_back]
+        menu_ask = [Button.text(option_ask, resize=True), menu_back]
+        self.menu_reply = Button.force_reply()
+
+        self.menu_main = [
+            [Button.text(option_goods, resize=True), Button.text(option_pharmacies, resize=True)],
+            [Button.text(option_documents, resize=True), Button.text(option_reports, resize=True)],
+            [Button.text(option_defects, resize=True)]
+        ]
+
+        menu_goods = [
+            [Button.text(option_goods_find, resize=True)],
+            [Button.text(option_goods_add, resize=True)],
+            [Button.text(option_goods_link, resize=True)],
+            menu_ask
+        ]
+
+        menu_pharmacies = [
+            [Button.text(option_pharmacies_find, resize=True), Button.text(option_pharmacies_reply, resize=True)],
+            [Button.text(option_pharmacies_add, resize=True), Button.text(option_pharmacies_client, resize=True)],
+            [Button.text(option_pharmacies_schedule, resize=True), Button.text(option_pharmacies_phone, resize=True)],
+            [Button.text(option_pharmacies_map, resize=True), Button.text(option_pharmacies_name, resize=True)],
+            [Button.text(option_pharmacies_disable, resize=True)],
+            [Button.text(option_pharmacies_stop, resize=True)],
+            menu_ask
+        ]
+
+        menu_documents = [
+            [Button.text(option_documents_contracts, resize=True)],
+            [Button.text(option_documents_invoices, resize=True), Button.text(option_documents_acts, resize=True)],
+            [Button.text(option_documents_contact, resize=True)],
+            menu_ask
+        ]
+
+        menu_reports = [
+            [Button.text(option_reports_link, resize=True)],
+            [
+                Button.text(option_reports_quality, resize=True),
+                Button.text(option_reports_competitors, resize=True),
+                Button.text(option_reports_finance, resize=True)
+            ],
+            menu_ask
+        ]
+
+        menu_defects = [
+            [Button.text(option_defects_account, resize=True)],
+            [Button.text(option_defects_orders, resize=True), Button.text(option_defects_rests, resize=True)],
+            menu_ask
+        ]
+
+        self.routes = {
+            # Option Ask/Comment
+            option_ask: Route(text_ask, self.menu_reply),
+            option_comment: Route(text_comment, self.menu_reply),
+            # Section Main
+            option_back: Route(keyboard=self.menu_main, documenting=False),
+            # Section Goods
+            option_goods: Route(keyboard=menu_goods),
+            option_goods_find: Route(
+                'Товар може не відображатися з деяких причин, основні з яких:\n'
+                ' 🔹 Аптека не надсилає залишки товару\n'
+                ' 🔹 Ціна резервування товару вища від ціни в аптеці\n'
+                ' 🔹 Відсутня прив\'язка товарної позиції\n'
+                ' 🔹 Товар заблокований\n'
+                ' 🔹 Аптека відключена\n'
+                'Ви можете знайти причину, користуючись інструкцією за посиланням:\n'
+                'У разі, якщо причина не виявлена, надішліть звернення менеджеру, '
+                'натиснувши кнопку «' + option_comment + '» та вкажіть:\n'
+                ' 🔹 Назву товару\n'
+                ' 🔹 Виробника\n'
+                ' 🔹 Внутрішній код товару\n'
+                ' 🔹 Серійний номер аптеки',
+                hours=6
+            ),
+            option_goods_add: Route(
+                'Додавання нового товару в каталог можливо '
+                'у разі одержання від заявника інформації про товар в наступному форматі:\n'
+                'Товарна позиція буде введена в каталог, а по факту '
+                'введення картки товару в каталог, Вас повідомлять 🔔',
+                hours=24
+            ),
+            option_goods_link: Route(
+                'У разі виявлення некоректної прив\'язки товару, є можливість її відкоригувати, '
+                'виконавши дії, описані в інструкції за посиланням:\n'
+                'Після проведення прив\'язки товару в особистому кабінеті, '
+                'вона проходить модерацію і тільки після цього фіксуються зміни 🪢',
+                hours=24
+            ),
+            # Section Pharmacies
+            option_pharmacies: Route(keyboard=menu_pharmacies),
+            option_pharmacies_find: Route(
+                'Припинення відображення аптеки на можливо за таких обставин:\n'
+                ' 🔹 Аптека відключена в особистому кабінеті\n'
+                ' 🔹 Своєчасно несплачені рахунки\n'
+                ' 🔹 Є неотримані/необроблені замовлення\n'
+                ' 🔹 Відсутнє оновлення інформації по залишкам товарів і цін більше доби\n'
+                'Самостійно виявити причину можливо, користуючись інструкцією за посиланням:\n'
+                'Якщо не знайшли відповіді, звертайтесь до менеджера:\n'
+                'Натисніть кнопку «' + option_comment + '» та вкажіть СЕРІЙНИЙ НОМЕР аптеки 👇',
+                hours=6
+            ),
+            option_pharmacies_reply: Route(
+                'Натисніть кнопку «' + option_comment + '» та впишіть відповідь на звернення 👇',
+                hours=4
+            ),
+            option_pharmacies_add: Route(
+                'Для того, щоб додати нову аптеку 🏥 з метою її подальшої трансляції, '
+                'потрібно виконати дії описані в інструкції за посиланням:\n'
+                'По факту додавання аптеки в реєстр менеджер по роботі з аптечними мережами '
+                'відправить Вам серійний номер цієї аптеки для подальшого вивантаження даних залишків і цін.',
+                hours=24
+            ),
+            option_pharmacies_schedule: Route(
+                'Змінити 📆 графік роботи аптеки або ☎ телефон можливо, '
+                'користуючись інструкцією за посиланням:\n',
+                hours=6
+            ),
+            option_pharmacies_phone: Route(
+                'Змінити 📆 графік роботи аптеки або ☎ телефон можливо, '
+                'користуючись інструкцією за посиланням:\n',
+                hours=24
+            ),
+            option_pharmacies_map: Route(
+                'В разі виявлення помилки щодо розташування аптеки на карті 🗺 '
+                'можливо змінити точку, користуючись інструкцією за посиланням:\n'
+                'Після встановлення нової геолокації в особистому кабінеті, '
+                'зміни проходять перевірку та, після підтвердження менеджером, фіксуються на карті 📍',
+                hours=24
+            ),
+            option_pharmacies_name: Route(
+                'Для зміни назви аптеки виконайте дії, вказані в інструкції за посиланням:\n',
+                hours=6
+            ),
+            option_pharmacies_disable: Route(
+                'Відключити аптеку 🚫 від трансляції на сайті можливо самостійно в особистому кабінеті, '
+                'користуючись інструкцією за посиланням:\n'
+                'Якщо аптека відключається на тривалий термін 📆 і в наступному місяці '
+                'не планується робота, обов\'язково ПОВІДОМТЕ про це менеджера❗ 👇',
+                hours=4
+            ),
+            option_pharmacies_stop: Route(
+                'Для відключення мережі ❌ від трансляції, потрібно передати інформацію менеджеру.\n'
+                'Для цього натисніть кнопку «' + option_comment + '» '
+                'та обов\'язково повідомте причину відключення 👇',
+                hours=2
+            ),
+            option_pharmacies_client: Route(
+                'Вкажіть номер броні та причину необхідності надання номера телефона клієнта 👇',
+                hours=6
+            ),
+            # Section Documents
+            option_documents: Route(keyboard=menu_documents),
+            option_documents_contracts: Route(
+                'Питання по договорам Ви можете направити менеджеру.\n'
+                'Для цього натисніть кнопку «' + option_comment + '» та надішліть запитання 👇',
+                hours=24,
+                documenting=True
+            ),
+            option_documents_invoices: Route(
+                'Питання по рахункам Ви можете направити менеджеру.\n'
+                'Для цього натисніть кнопку «' + option_comment + '» та надішліть запитання 👇',
+                hours=6,
+                documenting=True
+            ),
+            option_documents_acts: Route(
+                'Питання по актам Ви можете направити менеджеру.\n'
+                'Для цього натисніть кнопку «' + option_comment + '» та надішліть запитання 👇',
+                hours=24,
+                documenting=True
+            ),
+            option_documents_contact: Route(
+                'При зміні відповідальної особи, '
+                'прохання надати інформацію про ПІБ, контактний телефон, e-mail нової контактної особи.\n'
+                'Натисніть кнопку «' + option_comment + '» та введіть інформацію для відправки даних 👇',
+                hours=24
+            ),
+            # Section Reports
+            option_reports: Route(keyboard=menu_reports),
+            option_reports_link: Route(
+                'Детальна інструкція по роботі зі звітом «Товари без прив\'язки» '
+                'та опис полів звіту є за посиланням:\n' + text_manager,
+                hours=24
+            ),
+            option_reports_quality: Route(
+                'Детальна інструкція по роботі зі звітом «Якість» '
+                'та опис полів звіту є за посиланням:\n' + text_manager,
+                hours=24
+            ),
+            option_reports_competitors: Route(
+                'Детальна інструкція по роботі зі звітом «Оточення» '
+                'та опис полів звіту є за посиланням:\n' + text_manager,
+                hours=24
+            ),
+            option_reports_finance: Route(
+                'Детальна інструкція по роботі зі звітом «Фінансовий» '
+                'та опис полів звіту є за посиланням:\n' + text_manager,
+                hours=24
+            ),
+            # Section Defects
+            option_defects: Route(keyboard=menu_defects),
+            option_defects_account: Route(
+                'Якщо Ви не можете відкрити сторінку 🖥 особистого кабінету, '
+                'або зафіксовано ⚠ збій в роботі, будь ласка, оформіть заявку в службу підтримки:\n'
+                'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. '
+                'Менеджер зв\'яжеться з вами в найкоротший термін 👇',
+                hours=24
+            ),
+            option_defects_orders: Route(
+                'Якщо в аптеку не надходять вже сформовані клієнтами 🛒 замовлення, '
+                'потрібно звернутись до IT-спеціалістів свого підприємства!\n'
+                'В разі, якщо технічні спеціалісти аптеки не можуть 😞 вирішити питання, '
+                'звертайтесь до менеджера:\n'
+                'Натисніть кнопку «' + option_comment + '», опишіть проблему ✍ та відправте повідомлення. '
+                'Менеджер зв\'яжеться з вами в найкоротший термін 👇',
+                hours=6
+            ),
+            option_defects_rests: Route(
+                'Перевірити статус надходження 📦 залишків можливо, '
+                'виконавши дії згідно інструкціЇ за посиланням:\n' + text_manager,
+                hours=6
+            ),
+        }
+
+    def route(self, text):
+        """Returns the route of a client's input."""
+
+        if text.startswith('/start'):
+            return self.routes[option_back]
+
+        return self.routes.get(text)
+
+    def hours(self, topic):
+        """Returns response time of a comment on the given topic."""
+
+        route = self.routes.get(topic)
+        return default_hours if route is None else route.hours
+
+
+# Prompt types of the bot's messages
+prompt_auth = 'auth'
+prompt_comment = 'comment'
+
+
+def prompt_kind(text):
+    """Returns the prompt type of a bot's message, an empty string if it's not a prompt."""
+
+    if not text:
+        return ''
+    if text.endswith(text_auth):
+        return prompt_auth
+    if text in (text_ask, text_comment):
+        return prompt_comment
+
+    return ''
@@ -0,0 +1,192 @@
+"""
+Metrics of the bot in the Prometheus text format
+"""
+
+import asyncio
+import bisect
+import logging
+import os
+
+
+class Counter:
+    """A class to represent a monotonically increasing metric."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    """A class to represent a metric that goes up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram:
+    """A class to represent a distribution of observed values over fixed buckets."""
+
+    kind = 'histogram'
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *labels):
+        data = self._values.get(labels)
+        if data is None:
+            # Counts per bucket (the last one is +Inf), the sum and the count of the observations
+            data = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self._values[labels] = data
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def count(self, *labels):
+        data = self._values.get(labels)
+        return 0 if data is None else data[2]
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield self.name + '_bucket', labels + (('le', le),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Registry:
+    """
+    A class to represent the set of the bot's metrics.
+
+    Methods
+    -------
+    counter(name, documentation, labels) : Counter
+    gauge(name, documentation, labels) : Gauge
+    histogram(name, documentation, labels, buckets) : Histogram
+    render() : str
+        Returns all the metrics in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=Histogram.default_buckets):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(name + self._render_labels(metric.labels, labels) + ' ' + repr(value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    @staticmethod
+    def _render_labels(names, labels):
+        pairs = []
+        for label in labels:
+            if isinstance(label, tuple):
+                pairs.append(label)
+            else:
+                pairs.append((names[len(pairs)], label))
+        if not pairs:
+            return ''
+
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return registry.counter(name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    return registry.gauge(name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=Histogram.default_buckets):
+    return registry.histogram(name, documentation, labels, buckets)
+
+
+async def serve(port, host='127.0.0.1'):
+    """Serves the metrics over HTTP on the given port, runs until cancelled."""
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = registry.render().encode('utf-8')
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def dump(path, interval):
+    """Writes the metrics to a file every `interval` seconds, runs until cancelled."""
+
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        text = registry.render()
+        try:
+            await loop.run_in_executor(None, _write, path, text)
+        except OSError as e:
+            logging.warning('Metrics dump failed: %r', e)
+
+
+def _write(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,212 @@
+"""
+Outbound dispatcher of the bot's messages
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from telethon.errors import FloodWaitError
+from support_bot import metrics
+
+
+sends = metrics.counter('support_bot_sends_total', 'Sends to Telegram by status', ('status',))
+send_latency = metrics.histogram('support_bot_send_seconds', 'Send latency from queueing to delivery')
+send_pending = metrics.gauge('support_bot_sends_pending', 'Sends waiting in the outbox')
+flood_waits = metrics.counter('support_bot_flood_waits_total', 'FloodWait errors returned by Telegram')
+
+
+class TokenBucket:
+    """A class to represent a token bucket rate limiter."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self._rate = rate
+        self._capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def take(self):
+        """Takes a token and returns 0, or returns seconds to wait for the next one."""
+
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+
+        return (1 - self._tokens) / self._rate
+
+    def pause(self, seconds):
+        """Gives no tokens for the given seconds."""
+
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    async def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class Outbox:
+    """
+    A class to represent the outbound dispatcher.
+
+    Sends are queued per chat and delivered in FIFO order within a chat, while
+    different chats are served concurrently up to `concurrency`. A global and
+    a per-chat token bucket keep the bot under Telegram limits, and a FloodWait
+    pauses the global bucket for the time Telegram asks, while the waiting send
+    gives its concurrency slot back. A chat is resolved to its
+    input peer by `resolve` right before the send.
+
+    Methods
+    -------
+    send_message(chat, text, **kwargs) : Future
+        Queues a text message
+    send_file(chat, file, **kwargs) : Future
+        Queues a file
+    submit(chat, send) : Future
+        Queues a coroutine function that makes the send
+    stats() : dict
+        Returns queue depth and send latency metrics
+    """
+
+    def __init__(self, telegram, rate=30.0, chat_rate=1.0, chat_burst=3, concurrency=8, max_flood_retries=3,
+                 resolve=None):
+        self._telegram = telegram
+        self._resolve = (lambda chat: chat) if resolve is None else resolve
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = OrderedDict()
+        self._max_chat_buckets = 10000
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_flood_retries = max_flood_retries
+        self._queues = {}
+        self._workers = {}
+
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def send_message(self, chat, text, **kwargs):
+        return self.submit(chat, lambda: self._telegram.send_message(self._resolve(chat), text, **kwargs))
+
+    def send_file(self, chat, file, **kwargs):
+        return self.submit(chat, lambda: self._telegram.send_file(self._resolve(chat), file, **kwargs))
+
+    def submit(self, chat, send):
+        """Queues a send to a chat and returns a future of its result."""
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(self._retrieve)
+
+        queue = self._queues.get(chat)
+        if queue is None:
+            queue = deque()
+            self._queues[chat] = queue
+        queue.append((send, future, time.perf_counter()))
+        self.pending += 1
+        send_pending.set(self.pending)
+
+        if chat not in self._workers:
+            self._workers[chat] = loop.create_task(self._work(chat))
+
+        return future
+
+    def stats(self):
+        count = self.sent + self.failed
+        return {
+            'pending': self.pending,
+            'chats': len(self._queues),
+            'sent': self.sent,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'latency_avg': self.latency_total / count if count else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    async def _work(self, chat):
+        queue = self._queues[chat]
+        try:
+            while queue:
+                send, future, queued = queue.popleft()
+                await self._chat_bucket(chat).acquire()
+                retries = 0
+                while True:
+                    async with self._semaphore:
+                        await self._bucket.acquire()
+                        wait = await self._deliver(chat, send, future, retries)
+                    if wait is None:
+                        break
+                    # The whole bot waits out a FloodWait, this send is retried when the bucket resumes
+                    self._bucket.pause(wait)
+                    retries += 1
+
+                latency = time.perf_counter() - queued
+                self.pending -= 1
+                send_pending.set(self.pending)
+                send_latency.observe(latency)
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        finally:
+            del self._queues[chat]
+            del self._workers[chat]
+
+    async def _deliver(self, chat, send, future, retries):
+        """Makes a send attempt, returns seconds to wait before a retry or None if the send is done"""
+
+        try:
+            result = await send()
+        except FloodWaitError as e:
+            self.flood_waits += 1
+            flood_waits.inc()
+            if retries >= self._max_flood_retries:
+                self._fail(chat, future, e)
+                return None
+            return e.seconds
+        except Exception as e:
+            self._fail(chat, future, e)
+            return None
+
+        self.sent += 1
+        sends.inc('ok')
+        if not future.done():
+            future.set_result(result)
+
+        return None
+
+    def _fail(self, chat, future, error):
+        self.failed += 1
+        sends.inc('failed')
+        logging.warning('Send to %s failed: %r', chat, error)
+        if not future.done():
+            future.set_exception(error)
+
+    def _chat_bucket(self, chat):
+        bucket = self._chat_buckets.get(chat)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chat_buckets[chat] = bucket
+            while len(self._chat_buckets) > self._max_chat_buckets:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat)
+
+        return bucket
+
+    @staticmethod
+    def _retrieve(future):
+        # Failures are logged by the outbox, so unawaited futures shouldn't warn about them
+        if not future.cancelled():
+            future.exception()
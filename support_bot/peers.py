@@ -0,0 +1,75 @@
+"""
+Cache of the input peers of the bot's managers and clients
+"""
+
+import asyncio
+import logging
+import time
+
+
+class PeerCache:
+    """
+    A class to represent the input peers cache.
+
+    Sending to a bare user id makes Telethon resolve it first, which may cost
+    a request. The peers are resolved once at startup and reused by every send.
+
+    Methods
+    -------
+    warm_up(users) : dict
+        Resolves the users' input peers concurrently and returns a report
+    peer(user) : object
+        Returns a user's cached input peer or the bare id on a miss
+    remember(user, peer) : None
+        Caches a user's input peer
+    """
+
+    def __init__(self, telegram, concurrency=16):
+        self._telegram = telegram
+        self._concurrency = concurrency
+        self._peers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._peers)
+
+    async def warm_up(self, users):
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def resolve(user):
+            async with semaphore:
+                try:
+                    self._peers[user] = await self._telegram.get_input_entity(user)
+                    return True
+                except Exception as e:
+                    logging.warning('Peer %s is not resolved: %r', user, e)
+                    return False
+
+        users = [user for user in set(users) if user not in self._peers]
+        results = await asyncio.gather(*(resolve(user) for user in users))
+        resolved = sum(results)
+
+        return {
+            'resolved': resolved,
+            'failed': len(results) - resolved,
+            'seconds': time.perf_counter() - started,
+        }
+
+    def peer(self, user):
+        peer = self._peers.get(user)
+        if peer is None:
+            self.misses += 1
+            return user
+
+        self.hits += 1
+        return peer
+
+    def remember(self, user, peer):
+        if peer is not None:
+            self._peers[user] = peer
+
+    def hit_ratio(self):
+        count = self.hits + self.misses
+        return self.hits / count if count else 0.0
@@ -0,0 +1,106 @@
+"""
+Sampling profiler of the running bot
+"""
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """
+    A class to represent an on-demand sampling profiler.
+
+    While a profile runs, a thread samples the stacks of all the threads, so calls
+    blocking the event loop or the CRM workers show up, and the event loop samples
+    the await chains of its suspended tasks. Stacks are counted in the collapsed
+    format of flame graphs. Nothing runs between profiles.
+
+    Methods
+    -------
+    profile(seconds) : dict
+        Samples the process for `seconds` and returns the collapsed stacks with a report
+    """
+
+    def __init__(self, interval=0.005, tasks_interval=0.05):
+        self._interval = interval
+        self._tasks_interval = tasks_interval
+        self._running = False
+
+    async def profile(self, seconds):
+        if self._running:
+            raise RuntimeError('A profile is already running')
+
+        self._running = True
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        thread_stacks = collections.Counter()
+        task_stacks = collections.Counter()
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._sample_threads, args=(thread_stacks, stop), name='profiler', daemon=True
+        )
+        thread.start()
+        try:
+            deadline = loop.time() + seconds
+            while loop.time() < deadline:
+                self._sample_tasks(task_stacks)
+                await asyncio.sleep(self._tasks_interval)
+        finally:
+            stop.set()
+            await loop.run_in_executor(None, thread.join)
+            self._running = False
+
+        stacks = thread_stacks + task_stacks
+        collapsed = ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+        return {
+            'samples': sum(thread_stacks.values()),
+            'task_samples': sum(task_stacks.values()),
+            'seconds': time.perf_counter() - started,
+            'collapsed': collapsed,
+        }
+
+    def _sample_threads(self, stacks, stop):
+        own = threading.get_ident()
+        while not stop.wait(self._interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                frames.reverse()
+                stacks[self._collapse('thread ' + names.get(ident, str(ident)), frames)] += 1
+
+    def _sample_tasks(self, stacks):
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is current or task.done():
+                continue
+
+            # Follow the await chain from the task's coroutine down to where it's suspended
+            frames = []
+            coro = task.get_coro()
+            while coro is not None:
+                frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+                if frame is None:
+                    break
+                frames.append(frame)
+                coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+            if frames:
+                stacks[self._collapse('task', frames)] += 1
+
+    @staticmethod
+    def _collapse(root, frames):
+        names = [root]
+        for frame in frames:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+
+        return ';'.join(names)
@@ -0,0 +1,72 @@
+"""
+Index of the messages sent by the bot to resolve replies without Telegram requests
+"""
+
+from collections import OrderedDict
+
+
+class Prompt:
+    """
+    A class to represent a message sent by the bot.
+
+    Attributes
+    ----------
+    kind : str
+        Prompt type of the message (see `menu.prompt_kind`)
+    client : int
+        Client's id the message is about, 0 if unknown
+    """
+
+    __slots__ = ('kind', 'client')
+
+    def __init__(self, kind='', client=0):
+        self.kind = kind
+        self.client = client
+
+
+class ReplyIndex:
+    """A class to represent a bounded LRU index of sent messages keyed by chat and message id."""
+
+    def __init__(self, maxsize=50000):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def add(self, chat, message_id, prompt):
+        key = (chat, message_id)
+        self._data[key] = prompt
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, chat, message_id):
+        """Returns the prompt of a sent message or None if it isn't indexed."""
+
+        key = (chat, message_id)
+        prompt = self._data.get(key)
+        if prompt is None:
+            self.misses += 1
+        else:
+            self._data.move_to_end(key)
+            self.hits += 1
+
+        return prompt
+
+
+def parse_client(text):
+    """Returns a client's id from a 'Клієнт: <id>' header of a message, 0 if there is none."""
+
+    start_text = 'Клієнт: '
+    end_text = '\n'
+    try:
+        start = text.find(start_text) + len(start_text)
+        end = text.find(end_text)
+        client = int(text[start:end])
+    except (AttributeError, ValueError):
+        client = 0
+
+    return client
@@ -0,0 +1,88 @@
+"""
+Load-aware routing of tickets across managers
+"""
+
+import time
+
+
+class ManagerLoad:
+    """A class to represent a manager's live load."""
+
+    __slots__ = ('open', 'responses', 'response_mean')
+
+    def __init__(self):
+        self.open = 0
+        self.responses = 0
+        self.response_mean = 0.0
+
+
+class LoadBalancer:
+    """
+    A class to represent the tickets' balancer.
+
+    It keeps open tickets count and mean first response time per manager, both
+    updated incrementally as tickets open, get answered and close.
+
+    Methods
+    -------
+    open(client, manager) : None
+        Opens a client's ticket on a manager
+    respond(client) : None
+        Registers the first manager's response on a client's ticket
+    close(client) : None
+        Closes a client's ticket
+    manager(client) : int
+        Returns the manager of a client's open ticket, 0 if there's none
+    choose(managers) : int
+        Returns the least loaded manager of the given ones
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._loads = {}
+        self._tickets = {}
+
+    def load(self, manager):
+        load = self._loads.get(manager)
+        if load is None:
+            load = ManagerLoad()
+            self._loads[manager] = load
+
+        return load
+
+    def open(self, client, manager):
+        self.close(client)
+        self._tickets[client] = [manager, self._clock(), False]
+        self.load(manager).open += 1
+
+    def respond(self, client):
+        ticket = self._tickets.get(client)
+        if ticket is None or ticket[2]:
+            return
+
+        manager, opened, _ = ticket
+        ticket[2] = True
+        load = self.load(manager)
+        load.responses += 1
+        load.response_mean += (self._clock() - opened - load.response_mean) / load.responses
+
+    def close(self, client):
+        ticket = self._tickets.pop(client, None)
+        if ticket is not None:
+            self.load(ticket[0]).open -= 1
+
+    def manager(self, client):
+        ticket = self._tickets.get(client)
+        return 0 if ticket is None else ticket[0]
+
+    def choose(self, managers):
+        best = None
+        best_key = None
+        for manager in managers:
+            load = self._loads.get(manager)
+            key = (0, 0.0) if load is None else (load.open, load.response_mean)
+            if best_key is None or key < best_key:
+                best = manager
+                best_key = key
+
+        return best
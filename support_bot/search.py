@@ -0,0 +1,109 @@
+"""
+Inverted index of the clients for the managers' search
+"""
+
+import re
+
+
+_word = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Returns the lowercase words of a text"""
+
+    return _word.findall(str(text).lower())
+
+
+class ClientIndex:
+    """
+    A class to represent the inverted index of the clients.
+
+    A client is indexed by the words of their name, their enterprise code and the
+    enterprise's description. Every word is indexed by its prefixes as well, so a
+    search looks up one posting per query word and intersects them starting with
+    the smallest one, and no search scans the clients.
+
+    A search limited to a set of clients walks either the smallest posting or the
+    set, whichever is smaller.
+
+    A whole word match scores twice a prefix match, and matches are weighted by
+    field: the enterprise code first, then the name, then the description.
+
+    Methods
+    -------
+    add(client, name, enterprise, description) : None
+        Indexes a client, replacing their previous entry
+    remove(client) : None
+        Drops a client from the index
+    search(query, within) : list
+        Returns ids of the clients (of the given set, if any) matching every query word, the best matches first
+    """
+
+    min_prefix = 2
+    weights = {'enterprise': 8, 'name': 4, 'description': 2}
+
+    def __init__(self):
+        self._postings = {}
+        self._terms = {}
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __contains__(self, client):
+        return client in self._terms
+
+    def add(self, client, name, enterprise, description=''):
+        self.remove(client)
+
+        scores = {}
+        fields = (('enterprise', enterprise), ('name', name), ('description', description))
+        for field, text in fields:
+            weight = self.weights[field]
+            for word in tokenize(text):
+                if scores.get(word, 0) < 2 * weight:
+                    scores[word] = 2 * weight
+                for end in range(self.min_prefix, len(word)):
+                    prefix = word[:end]
+                    if scores.get(prefix, 0) < weight:
+                        scores[prefix] = weight
+
+        for term, score in scores.items():
+            self._postings.setdefault(term, {})[client] = score
+        self._terms[client] = tuple(scores)
+
+    def remove(self, client):
+        for term in self._terms.pop(client, ()):
+            posting = self._postings[term]
+            del posting[client]
+            if not posting:
+                del self._postings[term]
+
+    def search(self, query, within=None):
+        postings = []
+        for word in set(tokenize(query)):
+            posting = self._postings.get(word)
+            if posting is None:
+                return []
+            postings.append(posting)
+        if not postings:
+            return []
+
+        postings.sort(key=len)
+        candidates = postings[0]
+        if within is not None and len(within) < len(candidates):
+            candidates = within
+        ranked = []
+        for client in candidates:
+            if within is not None and client not in within:
+                continue
+            score = 0
+            for posting in postings:
+                matched = posting.get(client)
+                if matched is None:
+                    break
+                score += matched
+            else:
+                ranked.append((-score, client))
+        ranked.sort()
+
+        return [client for _, client in ranked]
@@ -0,0 +1,92 @@
+"""
+Scheduler of the response deadlines of open tickets
+"""
+
+import asyncio
+import heapq
+import logging
+import time
+
+
+class SlaScheduler:
+    """
+    A class to represent the tickets' deadlines scheduler.
+
+    Deadlines are kept in a heap with one live entry per client. Cancelling
+    a deadline only forgets it (the heap entry is skipped when it pops up),
+    and the heap is rebuilt once stale entries outnumber live ones.
+
+    Methods
+    -------
+    schedule(client, deadline) : None
+        Sets a client's ticket deadline, a unix time
+    cancel(client) : None
+        Removes a client's ticket deadline
+    run() : None
+        Calls `escalate(client, deadline)` for every passed deadline, runs forever
+    """
+
+    def __init__(self, escalate, clock=time.time):
+        self._escalate = escalate
+        self._clock = clock
+        self._heap = []
+        self._deadlines = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, client):
+        return client in self._deadlines
+
+    def deadline(self, client):
+        entry = self._deadlines.get(client)
+        return None if entry is None else entry[0]
+
+    def schedule(self, client, deadline):
+        self._seq += 1
+        entry = (deadline, self._seq, client)
+        self._deadlines[client] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+        self._compact()
+
+    def cancel(self, client):
+        self._deadlines.pop(client, None)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._next_timeout()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # The nearest entry is live here, as stale ones are dropped by _next_timeout()
+            deadline, seq, client = heapq.heappop(self._heap)
+            del self._deadlines[client]
+            try:
+                await self._escalate(client, deadline)
+            except Exception:
+                logging.exception('Escalation of %s failed', client)
+
+    def _next_timeout(self):
+        """Returns seconds till the nearest live deadline, None if there are none."""
+
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][2]) != heap[0]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+
+        return heap[0][0] - self._clock()
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = list(self._deadlines.values())
+            heapq.heapify(self._heap)
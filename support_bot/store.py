@@ -0,0 +1,332 @@
+"""
+Durable store of the clients' registrations, conversation state and broadcasts
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+
+class ClientStore:
+    """
+    A class to represent the clients' store on top of SQLite in WAL mode.
+
+    Saved records are collected in memory and written by a background thread,
+    one transaction per `commit_interval` seconds (group commit), so the event
+    loop never waits for the disk. Triggers stamp every inserted client and every
+    change of a registration with a new version, whether it's written by the bot
+    or edited in the store directly, so the registrations changed since a load
+    can be read alone.
+
+    A registration is written as a whole row, while the conversation state is
+    written to its own columns alone, so the state writes never overwrite the
+    registrations edited in the store meanwhile.
+
+    Methods
+    -------
+    load(registry, batch) : int
+        Adds all the stored clients to a registry and returns their count
+    changes(since, batch) : generator
+        Yields the clients' data changed after the given version
+    last_version() : int
+        Returns the latest version stamped
+    save_ticket(client, manager, deadline) : None
+        Queues a client's open ticket with its manager and deadline to be written, the deadline may be None
+    drop_ticket(client) : None
+        Queues a client's ticket to be removed
+    load_tickets() : list
+        Returns all the stored tickets as (client, manager, deadline)
+    save_broadcast(broadcast) : None
+        Queues a new broadcast with its recipients to be written
+    save_delivery(broadcast, client, status) : None
+        Queues a broadcast delivery's status to be written
+    finish_broadcast(broadcast) : None
+        Queues a broadcast to be marked as finished
+    load_broadcasts() : list
+        Returns the unfinished broadcasts with their undelivered recipients
+    save(record) : None
+        Queues a client's registration to be written as a whole row
+    save_state(record) : None
+        Queues a client's conversation state to be written, keeping the registration
+    flush() : None
+        Writes all the queued records at once
+    close() : None
+        Flushes the queued records and stops the writer
+    """
+
+    columns = ('id', 'name', 'enterprise', 'manager', 'chatting', 'text', 'documenting')
+    state_columns = ('chatting', 'text', 'documenting')
+
+    def __init__(self, path, commit_interval=0.5):
+        self._path = path
+        self._commit_interval = commit_interval
+        self._pending = {}
+        self._pending_states = {}
+        self._pending_tickets = {}
+        self._pending_broadcasts = {}
+        self._pending_deliveries = {}
+        self._pending_finished = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        connection = self._connect()
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS clients (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL DEFAULT '',
+                    enterprise INTEGER NOT NULL DEFAULT 0,
+                    manager INTEGER NOT NULL DEFAULT 0,
+                    chatting INTEGER NOT NULL DEFAULT 0,
+                    text TEXT NOT NULL DEFAULT '',
+                    documenting INTEGER NOT NULL DEFAULT 0,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            connection.execute('CREATE INDEX IF NOT EXISTS clients_version ON clients (version)')
+            for trigger, event in (('clients_inserted', 'INSERT'),
+                                   ('clients_registered', 'UPDATE OF name, enterprise, manager')):
+                connection.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON clients
+                    BEGIN
+                        UPDATE clients SET version = (SELECT MAX(version) + 1 FROM clients) WHERE id = NEW.id;
+                    END
+                """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tickets (
+                    client INTEGER PRIMARY KEY,
+                    manager INTEGER NOT NULL,
+                    deadline REAL
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY,
+                    manager INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    target TEXT NOT NULL DEFAULT '',
+                    finished INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    broadcast INTEGER NOT NULL,
+                    client INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    PRIMARY KEY (broadcast, client)
+                )
+            """)
+        self._writer_connection = connection
+        self._write_lock = threading.Lock()
+
+        self._writer = threading.Thread(target=self._write_loop, name='client-store', daemon=True)
+        self._writer.start()
+
+    def is_empty(self):
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT 1 FROM clients LIMIT 1').fetchone() is None
+        finally:
+            connection.close()
+
+    def load(self, registry, batch=1000):
+        """Adds all the stored clients to the registry batch by batch."""
+
+        count = 0
+        for data in self.changes(0, batch):
+            registry.add(data)
+            count += 1
+
+        return count
+
+    def last_version(self):
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT COALESCE(MAX(version), 0) FROM clients').fetchone()[0]
+        finally:
+            connection.close()
+
+    def changes(self, since, batch=1000):
+        """Yields the clients' data committed after the given version."""
+
+        connection = self._connect()
+        try:
+            cursor = connection.execute(
+                'SELECT ' + ', '.join(self.columns) + ' FROM clients WHERE version > ?',
+                (since,)
+            )
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    data = dict(zip(self.columns, row))
+                    data['chatting'] = bool(data['chatting'])
+                    data['documenting'] = bool(data['documenting'])
+                    yield data
+        finally:
+            connection.close()
+
+    def save(self, record):
+        row = tuple(getattr(record, column) for column in self.columns)
+        with self._lock:
+            self._pending[record.id] = row
+        self._wakeup.set()
+
+    def save_state(self, record):
+        row = tuple(getattr(record, column) for column in self.state_columns) + (record.id,)
+        with self._lock:
+            self._pending_states[record.id] = row
+        self._wakeup.set()
+
+    def save_ticket(self, client, manager, deadline):
+        with self._lock:
+            self._pending_tickets[client] = (manager, deadline)
+        self._wakeup.set()
+
+    def drop_ticket(self, client):
+        with self._lock:
+            self._pending_tickets[client] = None
+        self._wakeup.set()
+
+    def load_tickets(self):
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT client, manager, deadline FROM tickets').fetchall()
+        finally:
+            connection.close()
+
+    def save_broadcast(self, broadcast):
+        with self._lock:
+            self._pending_broadcasts[broadcast.id] = broadcast
+        self._wakeup.set()
+
+    def save_delivery(self, broadcast, client, status):
+        with self._lock:
+            self._pending_deliveries[(broadcast, client)] = status
+        self._wakeup.set()
+
+    def finish_broadcast(self, broadcast):
+        with self._lock:
+            self._pending_finished.add(broadcast)
+        self._wakeup.set()
+
+    def load_broadcasts(self):
+        connection = self._connect()
+        try:
+            broadcasts = []
+            rows = connection.execute('SELECT id, manager, message_id, target FROM broadcasts WHERE finished = 0')
+            for broadcast, manager, message_id, target in rows.fetchall():
+                counts = dict(connection.execute(
+                    'SELECT status, COUNT(*) FROM deliveries WHERE broadcast = ? GROUP BY status', (broadcast,)
+                ).fetchall())
+                clients = [row[0] for row in connection.execute(
+                    "SELECT client FROM deliveries WHERE broadcast = ? AND status = 'pending'", (broadcast,)
+                )]
+                broadcasts.append({
+                    'id': broadcast, 'manager': manager, 'message_id': message_id, 'target': target,
+                    'clients': clients, 'sent': counts.get('sent', 0), 'failed': counts.get('failed', 0),
+                })
+
+            return broadcasts
+        finally:
+            connection.close()
+
+    def flush(self):
+        with self._lock:
+            rows = list(self._pending.values())
+            self._pending.clear()
+            states = list(self._pending_states.values())
+            self._pending_states.clear()
+            tickets = self._pending_tickets
+            self._pending_tickets = {}
+            broadcasts = self._pending_broadcasts
+            self._pending_broadcasts = {}
+            deliveries = self._pending_deliveries
+            self._pending_deliveries = {}
+            finished = self._pending_finished
+            self._pending_finished = set()
+
+        if not rows and not states and not tickets and not broadcasts and not deliveries and not finished:
+            return
+
+        columns = self.columns
+        placeholders = ', '.join('?' * len(columns))
+        updates = ', '.join(f'{column} = excluded.{column}' for column in columns[1:])
+        query = f'INSERT INTO clients ({", ".join(columns)}) VALUES ({placeholders}) ' \
+                f'ON CONFLICT(id) DO UPDATE SET {updates}'
+        state_query = f'UPDATE clients SET {", ".join(f"{column} = ?" for column in self.state_columns)} WHERE id = ?'
+        try:
+            with self._write_lock, self._writer_connection:
+                connection = self._writer_connection
+                connection.executemany(query, rows)
+                connection.executemany(state_query, states)
+                connection.executemany(
+                    'DELETE FROM tickets WHERE client = ?',
+                    [(client,) for client, ticket in tickets.items() if ticket is None]
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO tickets (client, manager, deadline) VALUES (?, ?, ?)',
+                    [(client,) + ticket for client, ticket in tickets.items() if ticket is not None]
+                )
+                for broadcast in broadcasts.values():
+                    connection.execute(
+                        'INSERT OR IGNORE INTO broadcasts (id, manager, message_id, target) VALUES (?, ?, ?, ?)',
+                        (broadcast.id, broadcast.manager, broadcast.message_id, broadcast.target)
+                    )
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO deliveries (broadcast, client) VALUES (?, ?)',
+                        [(broadcast.id, client) for client in broadcast.clients]
+                    )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO deliveries (broadcast, client, status) VALUES (?, ?, ?)',
+                    [(broadcast, client, status) for (broadcast, client), status in deliveries.items()]
+                )
+                connection.executemany(
+                    'UPDATE broadcasts SET finished = 1 WHERE id = ?', [(broadcast,) for broadcast in finished]
+                )
+        except sqlite3.Error:
+            # Keep the records for the next commit unless they're already updated
+            with self._lock:
+                for row in rows:
+                    self._pending.setdefault(row[0], row)
+                for row in states:
+                    self._pending_states.setdefault(row[-1], row)
+                for client, ticket in tickets.items():
+                    self._pending_tickets.setdefault(client, ticket)
+                for broadcast_id, broadcast in broadcasts.items():
+                    self._pending_broadcasts.setdefault(broadcast_id, broadcast)
+                for key, status in deliveries.items():
+                    self._pending_deliveries.setdefault(key, status)
+                self._pending_finished |= finished
+            raise
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        self._writer_connection.close()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                break
+
+            # Let more records gather to commit them in one transaction
+            time.sleep(self._commit_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error('Client store write failed: %r', e)
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        return connection